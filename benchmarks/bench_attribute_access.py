@@ -0,0 +1,74 @@
+# Microbenchmark of the per-read cost of Preferences attributes.
+# Compares the current code with the prefy/prefy.py of a baseline git revision, the first commit of the repository by default.
+# Usage: python benchmarks/bench_attribute_access.py [--baseline <revision>]
+import argparse
+import importlib.util
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prefy import Preferences
+
+READS = 200000
+
+
+REPOSITORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def first_revision():
+    return subprocess.check_output(["git", "rev-list", "--max-parents=0", "HEAD"], cwd=REPOSITORY, text=True).split()[-1]
+
+
+def load_baseline(revision, directory):
+    # Imports the prefy/prefy.py of the given revision as a standalone module
+    source = subprocess.check_output(["git", "show", "{}:prefy/prefy.py".format(revision)], cwd=REPOSITORY)
+    path = os.path.join(directory, "baseline_prefy.py")
+    with open(path, "wb") as file:
+        file.write(source)
+    spec = importlib.util.spec_from_file_location("baseline_prefy", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def write_settings(directory, keys=50, updateable=5):
+    records = [{"key": "setting_{}".format(i), "value": i} for i in range(keys)]
+    records += [{"key": "live_{}".format(i), "value": i, "force_update": True} for i in range(updateable)]
+    with open(os.path.join(directory, "0.settings.json"), "w") as file:
+        json.dump(records, file)
+
+
+def per_read_ns(prefs, name, number):
+    return timeit.timeit(lambda: getattr(prefs, name), number=number) / number * 1e9
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare the per-read cost of Preferences attributes with a baseline revision.")
+    parser.add_argument("--baseline", help="Git revision of the baseline. Defaults to the first commit of the repository.")
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.WARNING)
+    revision = args.baseline or first_revision()
+    with tempfile.TemporaryDirectory() as directory:
+        baseline = load_baseline(revision, directory)
+        settings = os.path.join(directory, "settings")
+        os.makedirs(settings)
+        write_settings(settings)
+        current = Preferences(settings)
+        before = baseline.Preferences(settings)
+        print("Baseline: {}".format(revision))
+        print("{:<28}{:>14}{:>14}".format("read", "baseline (ns)", "current (ns)"))
+        for label, name, number in (("plain setting", "setting_0", READS),
+                                    ("method lookup", "check_setting_value", READS),
+                                    ("force_update setting", "live_0", READS // 100)):
+            print("{:<28}{:>14.0f}{:>14.0f}".format(label, per_read_ns(before, name, number), per_read_ns(current, name, number)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+# Benchmark suite for Preferences and PreferencesCollection.
+# Generates synthetic settings trees over a grid of parameters and measures the cost of the hot paths:
+# construction, plain reads, force_update reads, refresh() with and without changed files, and peak memory.
+# Results are emitted as JSON so that they can be compared across releases.
+# Usage: python benchmarks/bench_suite.py --files 10,100 --keys 20 --output results.json
+import argparse
+import itertools
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+import timeit
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from prefy import Preferences, PreferencesCollection
+
+SEED = 42
+READS = 20000
+FORCE_UPDATE_READS = 200
+
+
+def write_tree(directory, files, keys, txt_size, force_fraction, rng):
+    # Writes `files` JSON files of `keys` records each. Half of the keys are shared so that later files override earlier ones.
+    # When txt_size is positive, one .txt file of that size is written for every ten JSON files.
+    os.makedirs(directory, exist_ok=True)
+    for i in range(files):
+        records = []
+        for j in range(keys):
+            key = "shared_{}".format(j) if j % 2 == 0 else "file{}_key{}".format(i, j)
+            record = {"type": "Benchmark", "key": key, "value": "value {} {}".format(i, j)}
+            if rng.random() < force_fraction:
+                record["force_update"] = True
+            records.append(record)
+        with open(os.path.join(directory, "{:05d}.settings.json".format(i)), "w") as file:
+            json.dump(records, file)
+    if txt_size > 0:
+        for i in range(max(1, files // 10)):
+            with open(os.path.join(directory, "{:05d}_prompt {}.txt".format(i, i)), "w") as file:
+                file.write("x" * txt_size)
+
+
+def median_time(function, repeat, setup=None):
+    # setup, if given, runs before each call and is not timed
+    durations = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        start = time.perf_counter()
+        function()
+        durations.append(time.perf_counter() - start)
+    return statistics.median(durations)
+
+
+def change_files(directory):
+    # Rewrites the first JSON file, and the first .txt file if any, so that the next refresh has to re-read them
+    counter = itertools.count()
+    json_path = os.path.join(directory, "00000.settings.json")
+    txt_paths = sorted(f for f in os.listdir(directory) if f.endswith(".txt"))
+    with open(json_path) as file:
+        records = json.load(file)
+
+    def change():
+        # Sizes change on every call, since several writes may share the same modification time
+        revision = next(counter)
+        records[0]["value"] = "changed" + "!" * (revision % 2)
+        with open(json_path, "w") as file:
+            json.dump(records, file)
+        if txt_paths:
+            with open(os.path.join(directory, txt_paths[0]), "a") as file:
+                file.write("x")
+    return change
+
+
+def per_read_ns(prefs, name, number):
+    return timeit.timeit(lambda: getattr(prefs, name), number=number) / number * 1e9
+
+
+def peak_memory(function):
+    tracemalloc.start()
+    try:
+        result = function()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peak, result
+
+
+def bench_preferences(root, files, keys, txt_size, force_fraction, repeat):
+    directory = os.path.join(root, "prefs")
+    write_tree(directory, files, keys, txt_size, force_fraction, random.Random(SEED))
+    peak, prefs = peak_memory(lambda: Preferences(directory))
+    result = {
+        "construction_s": median_time(lambda: Preferences(directory), repeat),
+        "refresh_s": median_time(lambda: prefs.refresh(force_update=True), repeat),
+        "refresh_changed_s": median_time(lambda: prefs.refresh(force_update=True), repeat, setup=change_files(directory)),
+        "plain_read_ns": None,
+        "force_update_read_ns": None,
+        "peak_memory_bytes": peak,
+    }
+    plain_keys = [key for key in prefs.meta.loaded_values if key not in prefs.meta.updateable_fields]
+    if plain_keys:
+        result["plain_read_ns"] = per_read_ns(prefs, plain_keys[0], READS)
+    if prefs.meta.updateable_fields:
+        result["force_update_read_ns"] = per_read_ns(prefs, sorted(prefs.meta.updateable_fields)[0], FORCE_UPDATE_READS)
+    return result
+
+
+def bench_collection(root, subdirs, files, keys, txt_size, force_fraction, repeat):
+    parent = os.path.join(root, "collection")
+    rng = random.Random(SEED)
+    for i in range(subdirs):
+        write_tree(os.path.join(parent, "tenant{:05d}".format(i)), files, keys, txt_size, force_fraction, rng)
+    peak, _ = peak_memory(lambda: PreferencesCollection(parent))
+    return {
+        "collection_construction_s": median_time(lambda: PreferencesCollection(parent), repeat),
+        "collection_peak_memory_bytes": peak,
+    }
+
+
+def run(files, keys, txt_sizes, force_fractions, subdirs, repeat):
+    results = []
+    for file_count, key_count, txt_size, force_fraction, subdir_count in itertools.product(files, keys, txt_sizes, force_fractions, subdirs):
+        root = tempfile.mkdtemp(prefix="prefy-bench-")
+        try:
+            case = {"files": file_count, "keys_per_file": key_count, "txt_size": txt_size,
+                    "force_update_fraction": force_fraction, "subdirs": subdir_count}
+            case.update(bench_preferences(root, file_count, key_count, txt_size, force_fraction, repeat))
+            if subdir_count:
+                case.update(bench_collection(root, subdir_count, file_count, key_count, txt_size, force_fraction, repeat))
+            results.append(case)
+            print(json.dumps(case), file=sys.stderr)
+        finally:
+            shutil.rmtree(root)
+    return results
+
+
+def int_list(value):
+    return [int(v) for v in value.split(",")]
+
+
+def float_list(value):
+    return [float(v) for v in value.split(",")]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark Preferences and PreferencesCollection.")
+    parser.add_argument("--files", type=int_list, default=[10, 100], help="Comma-separated numbers of JSON files per directory.")
+    parser.add_argument("--keys", type=int_list, default=[10, 100], help="Comma-separated numbers of keys per file.")
+    parser.add_argument("--txt-size", type=int_list, default=[0, 100000], help="Comma-separated sizes of the .txt files, in characters.")
+    parser.add_argument("--force-fraction", type=float_list, default=[0.0, 0.1], help="Comma-separated fractions of force_update records.")
+    parser.add_argument("--subdirs", type=int_list, default=[0, 20], help="Comma-separated numbers of collection subdirectories (0 to skip).")
+    parser.add_argument("--repeat", type=int, default=5, help="Repetitions of each timed operation; the median is reported.")
+    parser.add_argument("--output", help="File where the JSON results are written. Defaults to stdout.")
+    args = parser.parse_args(argv)
+
+    logging.disable(logging.WARNING)
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "results": run(args.files, args.keys, args.txt_size, args.force_fraction, args.subdirs, args.repeat),
+    }
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1 +1,3 @@
-from .prefy import Preferences,PreferencesWrapper,PreferencesCollection
+from .prefy import Preferences,PreferencesWrapper,PreferencesCollection,PreferencesRegistry
+from .metrics import Metrics,PreferencesHooks
+from .aio import AsyncPreferences,AsyncPreferencesCollection
@@ -0,0 +1,129 @@
+import asyncio
+import functools
+import time
+import weakref
+
+from .prefy import DEFAULT_DIR, LazyText, Preferences, PreferencesCollection
+
+
+class AsyncPreferences:
+    # Asyncio counterpart of Preferences, created with `await AsyncPreferences.create(...)`.
+    # Every blocking file operation runs in an executor so that the event loop is never blocked:
+    # attribute reads are served from memory, including force_update settings, and `await get(name)`
+    # or `await refresh()` bring them up to date.
+    def __init__(self, preferences, executor=None):
+        self.preferences = preferences
+        self.executor = executor #None uses the loop's default executor
+        self.inflight = None #Future of the refresh in progress, shared by concurrent callers
+
+    @classmethod
+    async def create(cls, directory_path=DEFAULT_DIR, executor=None, **options):
+        # Accepts the same options as Preferences
+        loop = asyncio.get_running_loop()
+        preferences = await loop.run_in_executor(executor, functools.partial(Preferences, directory_path, **options))
+        return cls(preferences, executor)
+
+    def __getattr__(self, name):
+        # Never touches the disk: force_update settings are served from the published snapshot,
+        # and .txt files that are loaded lazily must first be read with `await get(name)`
+        if 'preferences' not in self.__dict__:
+            raise AttributeError(name)
+        snapshot = self.preferences.meta.snapshot
+        if name in snapshot.updateable_values:
+            return snapshot.updateable_values[name]
+        value = snapshot.lazy_values.get(name)
+        if value is not None:
+            if not value.loaded:
+                raise AttributeError("The content of '{}' is not loaded yet. Read it with `await get('{}')`.".format(name, name))
+            return value.content
+        return getattr(self.preferences, name)
+
+    def __iter__(self):
+        return iter(self.preferences)
+
+    def __repr__(self):
+        return repr(self.preferences)
+
+    async def refresh(self):
+        # Concurrent calls are deduplicated into a single load running in the executor. Returns the set of changed keys.
+        if self.inflight is None:
+            loop = asyncio.get_running_loop()
+            # Called through the class, so that a setting named `refresh` cannot shadow the method
+            self.inflight = loop.run_in_executor(self.executor, functools.partial(type(self.preferences).refresh, self.preferences, True))
+            self.inflight.add_done_callback(self.clear_inflight)
+        return await asyncio.shield(self.inflight)
+
+    def clear_inflight(self, future):
+        if self.inflight is future:
+            self.inflight = None
+
+    async def get(self, name):
+        # Reads a setting, first refreshing the settings if it is a force_update one whose max_age has passed
+        meta = self.preferences.meta
+        if name in meta.snapshot.updateable_fields and meta.refresh_on_read:
+            if not type(self.preferences).is_fresh(self.preferences, meta.max_ages.get(name, meta.max_age), time.monotonic()):
+                type(self.preferences).emit(self.preferences, 'on_force_update', self.preferences, name)
+                await self.refresh()
+        value = meta.snapshot.values.get(name)
+        if isinstance(value, LazyText) and not value.loaded:
+            if await asyncio.get_running_loop().run_in_executor(self.executor, value.load) is None:
+                return type(self.preferences).missing_attribute(self.preferences, name)
+        return type(self).__getattr__(self, name) #Not getattr(self, name), which would return a method of the same name
+
+    async def changes(self):
+        # Async iterator over the sets of keys changed by each refresh, whatever triggered it
+        queue = asyncio.Queue()
+        loop = asyncio.get_running_loop()
+        def callback(changed):
+            loop.call_soon_threadsafe(queue.put_nowait, changed)
+        type(self.preferences).subscribe(self.preferences, callback)
+        try:
+            while True:
+                yield await queue.get()
+        finally:
+            type(self.preferences).unsubscribe(self.preferences, callback)
+
+
+class AsyncPreferencesCollection:
+    # Asyncio counterpart of PreferencesCollection, created with `await AsyncPreferencesCollection.create(...)`.
+    # Items of lazy collections are loaded in the executor the first time they are requested.
+    def __init__(self, collection, executor=None):
+        self.collection = collection
+        self.executor = executor
+        self.wrappers = weakref.WeakValueDictionary() #AsyncPreferences in use, keyed by name. Weak so that evicted items can be freed.
+
+    @classmethod
+    async def create(cls, directory_path, executor=None, **options):
+        # Accepts the same options as PreferencesCollection
+        loop = asyncio.get_running_loop()
+        collection = await loop.run_in_executor(executor, functools.partial(PreferencesCollection, directory_path, **options))
+        return cls(collection, executor)
+
+    async def get_by_name(self, name):
+        item = self.collection.index.get(name)
+        if item is None:
+            return self.collection.get_by_name(name) #Raises the KeyError
+        return await self.wrap(item)
+
+    async def get_by_index(self, index):
+        if index < len(self.collection.items):
+            return await self.wrap(self.collection.items[index])
+        return self.collection.get_by_index(index) #Raises the IndexError
+
+    async def wrap(self, item):
+        if item.loaded:
+            preferences = item.preferences
+        else:
+            loop = asyncio.get_running_loop()
+            preferences = await loop.run_in_executor(self.executor, self.collection.load_item, item)
+        wrapper = self.wrappers.get(item.name)
+        if wrapper is None or wrapper.preferences is not preferences: #Reloaded after an eviction
+            wrapper = AsyncPreferences(preferences, self.executor)
+            self.wrappers[item.name] = wrapper
+        return wrapper
+
+    def list_names(self):
+        return self.collection.list_names()
+
+    def __len__(self):
+        return len(self.collection)
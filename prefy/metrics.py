@@ -0,0 +1,75 @@
+import threading
+from collections import Counter
+
+
+class PreferencesHooks:
+    # Base class of the instrumentation hooks passed to Preferences(hooks=[...]).
+    # Override the events you need, e.g. to export them to your own metrics system.
+    def on_refresh(self, preferences, duration, changed):
+        # A refresh completed in `duration` seconds and changed the values of the `changed` keys
+        pass
+
+    def on_file_read(self, preferences, file_name, bytes_read, read_time, parse_time):
+        # A settings file was read and parsed. Unchanged files are not read again and do not trigger this event.
+        pass
+
+    def on_file_skipped(self, preferences, file_name, reason):
+        # A file was read but not loaded. reason is 'deactivated' or 'invalid'.
+        pass
+
+    def on_force_update(self, preferences, key):
+        # Reading the force_update setting `key` triggered a refresh
+        pass
+
+
+class Metrics(PreferencesHooks):
+    # Default hooks of every Preferences instance, available as preferences.meta.metrics
+    def __init__(self):
+        self.lock=threading.Lock()
+        self.refresh_count=0
+        self.refresh_time=0.0 #Total, in seconds
+        self.last_refresh_time=None
+        self.files_read=0
+        self.bytes_read=0
+        self.read_time=0.0
+        self.parse_time=0.0
+        self.file_times={} #Latest (read_time, parse_time) of each file
+        self.files_skipped=Counter() #Per reason
+        self.force_update_refreshes=Counter() #Per key
+
+    def on_refresh(self, preferences, duration, changed):
+        with self.lock:
+            self.refresh_count += 1
+            self.refresh_time += duration
+            self.last_refresh_time = duration
+
+    def on_file_read(self, preferences, file_name, bytes_read, read_time, parse_time):
+        with self.lock:
+            self.files_read += 1
+            self.bytes_read += bytes_read
+            self.read_time += read_time
+            self.parse_time += parse_time
+            self.file_times[file_name] = (read_time, parse_time)
+
+    def on_file_skipped(self, preferences, file_name, reason):
+        with self.lock:
+            self.files_skipped[reason] += 1
+
+    def on_force_update(self, preferences, key):
+        with self.lock:
+            self.force_update_refreshes[key] += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                'refresh_count': self.refresh_count,
+                'refresh_time': self.refresh_time,
+                'last_refresh_time': self.last_refresh_time,
+                'files_read': self.files_read,
+                'bytes_read': self.bytes_read,
+                'read_time': self.read_time,
+                'parse_time': self.parse_time,
+                'file_times': dict(self.file_times),
+                'files_skipped': dict(self.files_skipped),
+                'force_update_refreshes': dict(self.force_update_refreshes),
+            }
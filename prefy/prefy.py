@@ -1,6 +1,20 @@
 import os
 import logging
 import json
+import threading
+import pickle
+import hashlib
+import locale
+import sys
+import weakref
+import copy
+import re
+from types import MappingProxyType
+import time
+from .metrics import Metrics
+from . import streaming
+from concurrent.futures import Executor, ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s -  %(filename)s - %(lineno)d - %(message)s')
 
@@ -11,12 +25,42 @@ VALUE="value"
 TYPE="type"
 FORCE_FIELD_UPDATE="force_update"
 RESTRICTED="restricted"
+MAX_AGE="max_age"
+
+#Watcher defaults, in seconds
+DEFAULT_DEBOUNCE=0.1
+DEFAULT_POLL_INTERVAL=1.0
+
+#Executor types for parallel loading
+THREAD="thread"
+PROCESS="process"
 
 #JSON values. Careful when changing as they are used in human-made documents
 INTERNAL_SETTINGS="Prefy"
 
 #Reserved keys
 DEACTIVATE="deactivate_setting_file"
+DEACTIVATION_VALUE=re.compile(r'"value"\s*:\s*(?:true|1(?:\.0*)?)(?![\w.])') #Values equal to True
+
+#Status of a parsed settings file
+LOADED="loaded"
+DEACTIVATED="deactivated"
+INVALID="invalid"
+
+class Unchanged: #Type of UNCHANGED. Unpickles to the module's own instance, so that worker processes can return it.
+        def __reduce__(self):
+            return 'UNCHANGED'
+
+        def __repr__(self):
+            return 'UNCHANGED'
+
+UNCHANGED=Unchanged() #Returned by scan_settings_file when a file's fingerprint did not change
+
+#Bumped whenever the format of compiled settings files changes
+COMPILED_VERSION=7
+
+#Maximum number of distinct files kept by the shared parse cache
+PARSE_CACHE_SIZE=4096
 
 class Meta: #Info about this instance
         def __init__(self): 
@@ -24,8 +68,132 @@ class Meta: #Info about this instance
             self.instantiated=False
             self.files=[]
             self.files_found=0
-            self.files_loaded=0
-            self.updateable_fields=[]
+            self.files_loaded=0 #Number of files loaded by the last refresh
+            self.metrics=Metrics()
+            self.hooks=[self.metrics] #Instrumentation hooks, see PreferencesHooks
+            self.snapshot=SettingsSnapshot() #Settings currently published from the files
+            self.file_entries={} #Parsed content of each file, keyed by file name
+            self.refresh_lock=threading.RLock() #Serializes refreshes coming from readers and watchers
+            self.refresh_on_read=True #False when a watcher keeps the settings up to date
+            self.watcher=None
+            self.subscribers=[] #Callbacks receiving the set of keys changed by a refresh
+            self.max_age=0 #Milliseconds during which force_update settings are served without refreshing
+            self.stale_while_revalidate=False
+            self.revalidating=False
+            self.refreshed_at=None #time.monotonic() at which the last successful refresh started
+            self.files_refreshed_at={} #Files re-read by targeted refreshes since then, with the time at which they started
+            self.workers=None #Number of workers used to read and parse the files in parallel
+            self.executor=THREAD #THREAD, PROCESS or a concurrent.futures.Executor instance
+            self.compiled_path=None #File where the merged settings are compiled for faster startups
+            self.share_parsed_files=False #Whether files are parsed through the process-wide PARSE_CACHE
+            self.shared_store=None #SharedStore shared with other processes
+            self.lazy_text=False #Whether .txt files are only read when their key is first accessed
+
+        # Shortcuts to the published snapshot
+        @property
+        def generation(self):
+            return self.snapshot.generation
+
+        @property
+        def loaded_values(self):
+            return self.snapshot.values
+
+        @property
+        def updateable_fields(self):
+            return self.snapshot.updateable_fields
+
+        @property
+        def updateable_values(self):
+            return self.snapshot.updateable_values
+
+        @property
+        def max_ages(self):
+            return self.snapshot.max_ages
+
+        @property
+        def key_sources(self):
+            return self.snapshot.sources
+
+
+class SettingsSnapshot: #Immutable generation of the settings loaded from the files. Refreshes publish a new one instead of mutating it.
+        def __init__(self, generation=0, values=None, updateable_fields=frozenset(), max_ages=None, sources=None):
+            self.generation=generation #Incremented each time a refresh changes the settings
+            self.values=MappingProxyType(dict(values or {})) #Merged values, including the updateable ones
+            self.updateable_fields=frozenset(updateable_fields) #Keys whose reads trigger a refresh
+            self.updateable_values=MappingProxyType({key: self.values[key] for key in self.updateable_fields if key in self.values})
+            self.max_ages=MappingProxyType(dict(max_ages or {})) #Per-key max_age overrides defined in the JSON records
+            self.lazy_values=MappingProxyType({key: value for key, value in self.values.items() if isinstance(value, LazyText)})
+            self.sources=MappingProxyType(dict(sources or {})) #(file name, record position) of each definition of a key, in merge order
+            self.attributes=MappingProxyType({key: value for key, value in self.values.items() if key not in self.updateable_fields and key not in self.lazy_values}) #Plain values, stored on the instance
+            self.read_through_keys=self.updateable_fields | self.lazy_values.keys() #Kept off the instance so that reading them goes through __getattr__
+
+        def get(self, key):
+            # Value of a key, reading the content of lazy .txt files
+            value=self.values[key]
+            return value.load() if isinstance(value, LazyText) else value
+
+
+class FileEntry: #Parsed content of a single settings file
+        def __init__(self, fingerprint, status, records=None, read_time=0.0, parse_time=0.0, deferred=False):
+            self.fingerprint=fingerprint
+            self.status=status #One of LOADED, DEACTIVATED or INVALID
+            self.records=records or [] #List of (key, value, force_update, internal, max_age) tuples
+            self.read_time=read_time #Seconds spent reading the file
+            self.parse_time=parse_time #Seconds spent parsing it
+            self.deferred=deferred #True for lazy .txt files, whose content has not been read yet
+            self.reported=False #Whether the file read events of this entry were emitted
+
+
+class LazyText: #Content of a .txt file, only read on first access and kept until the file's fingerprint changes
+        def __init__(self, filepath, fingerprint):
+            self.filepath=filepath
+            self.fingerprint=fingerprint
+            self.content=None
+
+        def load(self):
+            # Returns None if the file cannot be read, e.g. when it was removed before its first access
+            if self.content is None:
+                try:
+                    self.content=read_text_file(self.filepath)
+                except OSError as e:
+                    logging.warning("{} - Could not read '{}'.".format(e,self.filepath))
+            return self.content
+
+        @property
+        def loaded(self):
+            return self.content is not None
+
+        def __eq__(self, other):
+            return isinstance(other, LazyText) and (self.filepath, self.fingerprint) == (other.filepath, other.fingerprint)
+
+        def __hash__(self):
+            return hash((self.filepath, self.fingerprint))
+
+        def __getstate__(self): #The content is not pickled with compiled settings
+            return {'filepath': self.filepath, 'fingerprint': self.fingerprint, 'content': None}
+
+        def __repr__(self):
+            return self.content if self.content is not None else "<not loaded yet: '{}'>".format(self.filepath)
+
+
+class MergedSettings: #Result of merging the files of a directory in alphabetical order
+        def __init__(self, values, updateable_fields, max_ages, files_loaded, sources=None):
+            self.values=values
+            self.updateable_fields=updateable_fields
+            self.max_ages=max_ages
+            self.files_loaded=files_loaded
+            self.sources=sources or {}
+
+
+class CompiledSettings: #Content of a compiled settings file
+        def __init__(self, directory_path, file_entries, merged):
+            self.version=COMPILED_VERSION
+            self.directory_path=os.path.abspath(directory_path)
+            self.file_entries=file_entries
+            self.merged=merged
+
+        def fingerprints(self):
+            return {file_name: entry.fingerprint for file_name, entry in self.file_entries.items()}
 
 
 class Preferences:    
@@ -35,9 +203,13 @@ class Preferences:
     def __iter__(self):
         # Return an iterator over the non-meta attributes
         attrs = {k: v for k, v in vars(self).items() if k != 'meta'}
+        attrs.update(self.meta.snapshot.updateable_values)
+        for key, value in self.meta.snapshot.lazy_values.items():
+            if value.load() is not None:
+                attrs[key] = value.content
         return iter(attrs.items())
     
-    def __init__(self, directory_path=DEFAULT_DIR, bypass_directory=False, ad_hoc_prefs=None, allow_missing_attributes=False,**kwargs):
+    def __init__(self, directory_path=DEFAULT_DIR, bypass_directory=False, ad_hoc_prefs=None, allow_missing_attributes=False, watch=False, on_change=None, max_age=0, stale_while_revalidate=False, workers=None, executor=THREAD, file_entries=None, compiled_path=None, hooks=None, share_parsed_files=False, lazy_text=False, shared_store=None,**kwargs):
         """
         Initializes a Preferences instance, loading settings from JSON and txt files in the specified directory.
 
@@ -46,6 +218,18 @@ class Preferences:
         bypass_directory (bool): If True, bypasses the directory and only loads the kwargs. Defaults to False.
         ad_hoc_prefs: A dictionary or list of tuples of ad-hoc preferences to set as attributes on the instance. Defaults to None.
         allow_missing_attributes: (bool): If True, allows missing attributes without raising an error. Defaults to False.
+        watch (bool): If True, a background thread watches the directory and applies changes as they happen, instead of refreshing when force_update settings are read. Defaults to False.
+        on_change (callable): Called with the set of changed keys whenever a refresh changes settings. Defaults to None.
+        max_age (int): Milliseconds during which force_update settings are served from memory before being refreshed. Records can override it with their own "max_age". Defaults to 0 (refresh on every read).
+        stale_while_revalidate (bool): If True, reading an expired force_update setting returns its current value while a background thread refreshes it. Defaults to False.
+        workers (int): If greater than 1, the files are read and parsed in parallel by this number of workers. Defaults to None (serial).
+        executor: 'thread', 'process' or a concurrent.futures.Executor instance used for parallel reads. Defaults to 'thread'.
+        file_entries (dict): Files already parsed by scan_directory(), reused when their fingerprint still matches. Defaults to None.
+        compiled_path (str): File where the merged settings are compiled. Later instances load it directly as long as no settings file changed, and rebuild it otherwise. Only point it to a trusted location since it is unpickled. Defaults to None.
+        hooks (list): PreferencesHooks instances notified of refreshes, file reads and force_update refreshes, in addition to meta.metrics. Defaults to None.
+        share_parsed_files (bool): If True, files are parsed through a process-wide cache keyed by file identity and content, so that instances loading identical files share the parsed values. Those values must then be treated as read-only. Cannot be combined with a process executor. Defaults to False.
+        lazy_text (bool): If True, the keys of .txt files are registered when loading but their content is only read the first time the key is accessed, and again only after the file changed. Defaults to False.
+        shared_store (str): Path of a settings store shared with other processes. The first process to open it loads the files, watches them and publishes the merged settings there. The others load them from the store and only reload them when a new generation is published. Only point it to a private location since the store is unpickled. Defaults to None.
         **kwargs: Additional keyword arguments to set as attributes on the instance. Useful for testing purposes.
 
         Raises:
@@ -53,17 +237,33 @@ class Preferences:
         Exception: For any other errors encountered during initialization.
         """
         try:    
+            check_shared_executor(share_parsed_files, workers, executor)
             self.meta = Meta()        
+            self.meta.max_age = max_age
+            self.meta.stale_while_revalidate = stale_while_revalidate
+            self.meta.workers = workers
+            self.meta.executor = executor
+            self.meta.compiled_path = compiled_path
+            self.meta.share_parsed_files = share_parsed_files
+            self.meta.lazy_text = lazy_text
+            if hooks is not None:
+                self.meta.hooks.extend(hooks)
+            if file_entries is not None:
+                self.meta.file_entries = dict(file_entries)
             if not bypass_directory:
                 if not os.path.isdir(directory_path):
                     logging.warning("Invalid directory: '{}'.".format(directory_path))
                     raise OSError("Invalid directory: '{}'.".format(directory_path))
                 
                 self.meta.directory_path = directory_path
-                self.refresh(force_update=False)
+                if shared_store is not None:
+                    from .shared import SharedStore
+                    self.meta.shared_store = SharedStore(shared_store, directory_path)
+                    watch = self.meta.shared_store.try_acquire_writer() or watch
+                type(self).refresh(self, force_update=False)
             
             if ad_hoc_prefs is not None:
-                self.set_ad_hoc_prefs(ad_hoc_prefs=ad_hoc_prefs)
+                type(self).set_ad_hoc_prefs(self, ad_hoc_prefs=ad_hoc_prefs)
                 
             self.allow_missing_attributes = allow_missing_attributes
                 
@@ -71,9 +271,15 @@ class Preferences:
                 for key, value in kwargs.items():
                     self.__setattr__(key, value)
                     self.meta.instantiated=True
+
+            # Methods are called through the class since settings stored on the instance may shadow them
+            if on_change is not None:
+                type(self).subscribe(self, on_change)
+            if watch and not bypass_directory:
+                type(self).watch(self)
             
                 
-        except OSError:
+        except (OSError, ValueError):
             raise
         
         except Exception as e:
@@ -96,60 +302,31 @@ class Preferences:
             raise Exception                   
     
     def refresh(self,force_update=True):
+        # Returns the set of keys whose value changed
+        changed=set()
         try:
             if force_update or self.meta.instantiated==False:     
-                # Get a list of JSON files in the directory
-                self.load_files()
-
-                # Loop through each JSON file
-                for file_name in self.meta.files:
-                    if file_name.endswith('.txt'):
-                        filepath = os.path.join(self.meta.directory_path, file_name)
-                        with open(filepath, 'r') as file:
-                            content = file.read().strip()
-                            # Extract key from the file name
-                            base_name = os.path.basename(file_name)
-                            key = base_name.split('_', 1)[-1].replace(' ', '_').lower().replace('.txt', '')
-                            # Upsert the content as a preference
-                            self.__setattr__(key, content)
-                            self.meta.files_loaded +=1
-                    elif file_name.endswith('.json'):
-                        filepath=os.path.join(self.meta.directory_path,file_name)
-                        targetFile=open(file=filepath, mode='r')
-                        content=targetFile.read()
-                        try:
-                            data = json.loads(content)
-                        except json.JSONDecodeError:
-                            logging.warning("Invalid JSON format in file '{}'.".format(filepath))
-                            continue
-                        
-                        # Check if the file should be skipped
-                        deactivate_setting = any(record.get(KEY) == DEACTIVATE and record.get(VALUE) == True
-                                                for record in data)
-                        if deactivate_setting:
-                            continue
-
-                        self.meta.files_loaded +=1
-                        # Process records other than type "Settiings"
-                        # TODO: Add logic to prevent overwriting existing settings when restricted=true 
-                        # TODO: Add logic to force update when force_update=true 
-                        for record in data:
-                            
-                            # Add updateable settings to a list
-                            if check_boolean_property_value(record,FORCE_FIELD_UPDATE):
-                                self.meta.updateable_fields.append(record.get(KEY))
-                            else:
-                                try:
-                                    self.meta.updateable_fields.remove(record.get(KEY))
-                                except ValueError:
-                                    pass
-                                
-                            #Upsert settings to Preferences   
-                            if record.get(TYPE) != INTERNAL_SETTINGS: 
-                                key = record.get(KEY)
-                                value = record.get(VALUE)
-                                self.__setattr__(key, value)
-                        self.meta.instantiated=True
+                with self.meta.refresh_lock:
+                    started=time.monotonic()
+                    store=self.meta.shared_store
+                    if store is not None and store.should_take_over():
+                        logging.info("Taking over the shared settings store '{}'.".format(store.path))
+                        self.meta.refresh_on_read=False
+                        threading.Thread(target=type(self).watch, args=(self,), name='prefy-takeover', daemon=True).start()
+                    if store is not None and not store.is_writer and store.generation:
+                        # Readers of a shared store load what the writer published instead of reading the files
+                        merged=type(self).read_shared_store(self)
+                    else:
+                        merged=type(self).load_merged(self)
+                    if merged is not None:
+                        generation=self.meta.snapshot.generation
+                        changed=type(self).publish(self, merged)
+                        if store is not None and store.is_writer and (self.meta.snapshot.generation != generation or not store.generation):
+                            store.publish(merged)
+                    self.meta.instantiated=True
+                    self.meta.refreshed_at=started
+                    self.meta.files_refreshed_at={}
+                    type(self).emit(self, 'on_refresh', self, time.monotonic()-started, changed)
                 
         except FileNotFoundError:
             raise
@@ -157,6 +334,239 @@ class Preferences:
         except Exception as e:
             logging.error('Error {} .'.format(e))
             raise Exception 
+
+        if changed:
+            type(self).notify(self, changed)
+        return changed
+
+    def load_merged(self):
+        # Get a list of JSON files in the directory
+        type(self).load_files(self)
+        merged=None
+        if self.meta.compiled_path is not None and not self.meta.instantiated:
+            merged=type(self).read_compiled(self)
+        if merged is None:
+            # Only re-parse the files that were added or changed since the last refresh
+            previous_entries=self.meta.file_entries
+            type(self).scan_files(self)
+            type(self).report_scanned_files(self)
+            merged=merge_file_entries(self.meta.files, self.meta.file_entries)
+            if self.meta.compiled_path is not None and not same_file_entries(previous_entries, self.meta.file_entries):
+                type(self).write_compiled(self, merged)
+        return merged
+
+    def refresh_keys(self, keys):
+        # Re-reads only the files defining the given keys, according to the key sources of the published snapshot,
+        # and merges them again with the files parsed by previous refreshes. Falls back to a full refresh when files
+        # were added to or removed from the directory since then. Returns the set of keys whose value changed.
+        file_names=type(self).source_files(self, keys)
+        if not file_names or not self.meta.instantiated or self.meta.shared_store is not None:
+            return type(self).refresh(self, force_update=True)
+        try:
+            listed=sorted([f for f in os.listdir(self.meta.directory_path) if f.endswith('.json') or f.endswith('.txt')])
+        except OSError:
+            listed=None
+        if listed != self.meta.files: #Any file may now override the keys, or may have stopped doing so
+            return type(self).refresh(self, force_update=True)
+        changed=set()
+        try:
+            with self.meta.refresh_lock:
+                started=time.monotonic()
+                previous_entries=self.meta.file_entries
+                entries=dict(previous_entries)
+                for file_name in file_names:
+                    previous=previous_entries.get(file_name)
+                    entry=scan_settings_file(os.path.join(self.meta.directory_path,file_name), previous.fingerprint if previous is not None else None,
+                                             self.meta.share_parsed_files, self.meta.lazy_text)
+                    if entry is None:
+                        entries.pop(file_name, None)
+                    elif entry is not UNCHANGED:
+                        entries[file_name]=entry
+                self.meta.files=[file_name for file_name in self.meta.files if file_name in entries or file_name not in file_names]
+                self.meta.files_found=len(self.meta.files)
+                self.meta.file_entries=entries
+                if same_file_entries(previous_entries, entries):
+                    # Nothing to merge again: only restore the file values over ad hoc ones, like publish() does
+                    type(self).publish_attributes(self, self.meta.snapshot)
+                else:
+                    type(self).report_scanned_files(self)
+                    merged=merge_file_entries(self.meta.files, entries)
+                    if self.meta.compiled_path is not None:
+                        type(self).write_compiled(self, merged)
+                    changed=type(self).publish(self, merged)
+                files_refreshed_at=dict(self.meta.files_refreshed_at)
+                files_refreshed_at.update((file_name, started) for file_name in file_names)
+                self.meta.files_refreshed_at=files_refreshed_at
+                type(self).emit(self, 'on_refresh', self, time.monotonic()-started, changed)
+
+        except Exception as e:
+            logging.error('Error {} .'.format(e))
+            raise Exception
+
+        if changed:
+            type(self).notify(self, changed)
+        return changed
+
+    def source_files(self, keys):
+        # Names of the files defining the given keys
+        sources=self.meta.snapshot.sources
+        return sorted({file_name for key in keys for file_name, _ in sources.get(key, ())})
+
+    def read_shared_store(self):
+        # Returns the settings published since the last read, None if there is nothing new
+        try:
+            return self.meta.shared_store.read(force=not self.meta.instantiated)
+        except Exception as e:
+            logging.warning("{} - Could not read the shared settings store '{}', loading the files instead.".format(e,self.meta.shared_store.path))
+            return type(self).load_merged(self)
+
+    def emit(self, event, *args):
+        # Calls the given event on every instrumentation hook
+        for hook in list(self.meta.hooks):
+            try:
+                getattr(hook, event)(*args)
+            except Exception as e:
+                logging.error('Error {} in {} hook.'.format(e,event))
+
+    def report_scanned_files(self):
+        # Emits the events of the files parsed since the last report, including those parsed by worker processes
+        for file_name, entry in self.meta.file_entries.items():
+            if entry.reported or entry.deferred:
+                continue
+            entry.reported=True
+            type(self).emit(self, 'on_file_read', self, file_name, entry.fingerprint[1], entry.read_time, entry.parse_time)
+            if entry.status != LOADED:
+                type(self).emit(self, 'on_file_skipped', self, file_name, entry.status)
+
+    def subscribe(self, callback):
+        # Registers a callback receiving the set of keys changed by each refresh
+        self.meta.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        try:
+            self.meta.subscribers.remove(callback)
+        except ValueError:
+            pass
+
+    def notify(self, changed):
+        for callback in list(self.meta.subscribers):
+            try:
+                callback(changed)
+            except Exception as e:
+                logging.error('Error {} in on_change callback for directory \'{}\'.'.format(e,self.meta.directory_path))
+
+    def watch(self, on_change=None, debounce=DEFAULT_DEBOUNCE, poll_interval=DEFAULT_POLL_INTERVAL):
+        # Applies changes from a background thread; reads of force_update settings stop touching the filesystem
+        from .watcher import Watcher
+        if on_change is not None:
+            type(self).subscribe(self, on_change)
+        if self.meta.watcher is None:
+            watcher=Watcher(debounce=debounce, poll_interval=poll_interval)
+            watcher.add(self)
+            watcher.start()
+            self.meta.watcher=watcher
+        self.meta.refresh_on_read=False
+        return self.meta.watcher
+
+    def stop_watching(self):
+        if self.meta.watcher is not None:
+            self.meta.watcher.stop()
+            self.meta.watcher=None
+        self.meta.refresh_on_read=True
+
+    def scan_files(self):
+        # Compares the fingerprint of each file with the one recorded during the previous refresh
+        previous=self.meta.file_entries
+        paths=[os.path.join(self.meta.directory_path,file_name) for file_name in self.meta.files]
+        fingerprints=[previous[file_name].fingerprint if file_name in previous else None for file_name in self.meta.files]
+        shared=[self.meta.share_parsed_files]*len(paths)
+        lazy_text=[self.meta.lazy_text]*len(paths)
+        if self.meta.workers and self.meta.workers > 1 and len(paths) > 1:
+            # Only the files whose fingerprint changed are handed to the workers, so that refreshes with nothing to re-read do not start a pool
+            scanned=[UNCHANGED if has_fingerprint(path, fingerprint) else None for path, fingerprint in zip(paths, fingerprints)]
+            stale=[index for index, entry in enumerate(scanned) if entry is None]
+            arguments=[[paths[index] for index in stale], [fingerprints[index] for index in stale], shared[:len(stale)], lazy_text[:len(stale)]]
+            if len(stale) > 1:
+                results=run_in_executor(scan_settings_file, arguments, self.meta.workers, self.meta.executor)
+            else:
+                results=map(scan_settings_file, *arguments)
+            for index, entry in zip(stale, results):
+                scanned[index]=entry
+        else:
+            scanned=map(scan_settings_file, paths, fingerprints, shared, lazy_text)
+
+        entries={}
+        for file_name, entry in zip(self.meta.files, scanned):
+            if entry is UNCHANGED:
+                entry=previous[file_name]
+            if entry is not None:
+                entries[file_name]=entry
+        self.meta.file_entries=entries
+
+    def apply_files(self):
+        # Merges the parsed files and publishes the result. Returns the set of keys whose value changed.
+        return type(self).publish(self, merge_file_entries(self.meta.files, self.meta.file_entries))
+
+    def publish(self, merged):
+        # Builds the next generation of the settings off to the side and publishes it with a reference swap,
+        # so that concurrent readers never see a mix of old and new files and never need a lock.
+        # Returns the set of keys whose value changed.
+        self.meta.files_loaded = merged.files_loaded
+        current=self.meta.snapshot
+        previous=current.values
+        values=merged.values
+        changed={key for key in previous.keys() | values.keys()
+                 if key not in previous or key not in values or not same_value(previous[key], values[key])}
+        if not changed and merged.updateable_fields == current.updateable_fields and merged.max_ages == current.max_ages \
+                and merged.sources == current.sources:
+            type(self).publish_attributes(self, current)
+            return changed
+
+        # The parsed records are cached between refreshes, so the settings get their own copy of mutable values.
+        # Changes made to them by the application are then detected and undone by the next refresh, like a re-parse would.
+        # Instances sharing parsed files share the values too, which they must treat as read-only.
+        if not self.meta.share_parsed_files:
+            values={key: previous[key] if key not in changed else copy_value(value) for key, value in values.items()}
+        snapshot=SettingsSnapshot(current.generation+1, values, merged.updateable_fields, merged.max_ages, merged.sources)
+        for key in changed & values.keys():
+            if callable(getattr(type(self), key, None)):
+                logging.warning("Setting '{}' of directory '{}' has the name of a Preferences method. Attribute reads may return one instead of the other.".format(key,self.meta.directory_path))
+        self.meta.snapshot=snapshot
+        type(self).publish_attributes(self, snapshot, retracted=previous.keys() - values.keys())
+        return changed
+
+    def publish_attributes(self, snapshot, retracted=()):
+        # Stores the plain values of the snapshot on the instance, on every refresh: file values take precedence over
+        # ad hoc ones whether or not a file changed. They are merged into __dict__ with a single update rather than
+        # replacing it, so that attributes set by other threads in the meantime are kept.
+        attributes=self.__dict__
+        attributes.update(snapshot.attributes)
+        for key in retracted:
+            attributes.pop(key, None)
+        for key in snapshot.read_through_keys:
+            attributes.pop(key, None)
+
+    def read_compiled(self):
+        # Reuses the compiled settings when none of the files changed since they were written.
+        # Returns the merged settings on a hit, None otherwise. Files that did not change are still reused on a miss.
+        compiled=read_compiled_file(self.meta.compiled_path, self.meta.directory_path)
+        if compiled is None:
+            return None
+        self.meta.file_entries=compiled.file_entries
+        try:
+            fingerprints={file_name: file_fingerprint(os.path.join(self.meta.directory_path,file_name)) for file_name in self.meta.files}
+        except FileNotFoundError:
+            return None
+        if fingerprints != compiled.fingerprints():
+            logging.info("Compiled settings '{}' are outdated, rebuilding them.".format(self.meta.compiled_path))
+            return None
+        return compiled.merged
+
+    def write_compiled(self, merged):
+        try:
+            write_compiled_file(self.meta.compiled_path, CompiledSettings(self.meta.directory_path, self.meta.file_entries, merged))
+        except OSError as e:
+            logging.warning("{} - Could not write compiled settings '{}'.".format(e,self.meta.compiled_path))
         
     def check_setting_value(self,setting_name):
         #Display the current value of a setting
@@ -183,57 +593,284 @@ class Preferences:
 
     def check_attribute_updateable(self, name):
         if name in self.meta.updateable_fields:
-            self.refresh(force_update=True)
+            type(self).refresh_if_stale(self, name)
             return True
         else:
             return False
 
+    def is_fresh(self, max_age, requested_at, keys=None):
+        # Fresh when refreshed less than max_age milliseconds ago, or when a refresh started after the read was requested.
+        # With keys, only the refreshes that re-read the files defining them count.
+        refreshed_at=self.meta.refreshed_at if keys is None else type(self).sources_refreshed_at(self, keys)
+        return refreshed_at is not None and (refreshed_at >= requested_at or (requested_at - refreshed_at)*1000 < max_age)
+
+    def sources_refreshed_at(self, keys):
+        # Start of the oldest refresh among the last ones that re-read each file defining the keys
+        refreshed_at=self.meta.refreshed_at
+        if refreshed_at is None:
+            return None
+        files_refreshed_at=self.meta.files_refreshed_at
+        return min((files_refreshed_at.get(file_name, refreshed_at) for file_name in type(self).source_files(self, keys)), default=refreshed_at)
+
+    def refresh_if_stale(self, name):
+        type(self).refresh_stale_keys(self, (name,))
+
+    def refresh_stale_keys(self, keys):
+        # Brings the force_update keys whose max_age has passed up to date with a single refresh of the files defining them
+        meta=self.meta
+        requested_at=time.monotonic()
+        def stale_keys():
+            return [key for key in keys if key in meta.updateable_fields and not type(self).is_fresh(self, meta.max_ages.get(key, meta.max_age), requested_at, (key,))]
+        stale=stale_keys()
+        if not stale:
+            return
+        if meta.stale_while_revalidate:
+            if type(self).revalidate_in_background(self):
+                for key in stale:
+                    type(self).emit(self, 'on_force_update', self, key)
+            return
+        with meta.refresh_lock:
+            # Concurrent readers wait for the refresh in progress instead of starting their own
+            stale=stale_keys()
+            if stale:
+                for key in stale:
+                    type(self).emit(self, 'on_force_update', self, key)
+                type(self).refresh_keys(self, stale)
+
+    def get_many(self, keys):
+        # Reads several settings at once, with the values attribute reads would return. The freshness of the
+        # force_update ones is checked in a single pass and the settings of the files come from the same snapshot. Returns a dict.
+        keys=list(keys)
+        type(self).refresh_many(self, keys)
+        return type(self).read_values(self, keys, self.meta.snapshot, self.__dict__)
+
+    def snapshot(self):
+        # Read-only mapping of all the settings, brought up to date like get_many()
+        type(self).refresh_many(self, self.meta.updateable_fields)
+        snapshot=self.meta.snapshot
+        attributes=self.__dict__
+        keys=[key for key in attributes if key != 'meta'] + [key for key in snapshot.values if key not in attributes]
+        return MappingProxyType(type(self).read_values(self, keys, snapshot, attributes))
+
+    def refresh_many(self, keys):
+        meta=self.meta
+        if meta.instantiated and meta.refresh_on_read:
+            try:
+                type(self).refresh_stale_keys(self, keys)
+            except Exception as e:
+                logging.warning("{} - Could not refresh the settings of directory '{}'. Returning the last known values.".format(e,meta.directory_path))
+
+    def read_values(self, keys, snapshot, attributes):
+        # Resolves the keys like attribute reads do: attributes stored on the instance first, then the snapshot
+        values={}
+        for key in keys:
+            if key in attributes and key != 'meta':
+                values[key]=attributes[key]
+            elif key in snapshot.values and (snapshot.get(key) is not None or key not in snapshot.lazy_values):
+                values[key]=snapshot.get(key)
+            else:
+                values[key]=type(self).missing_attribute(self, key)
+        return values
+
+    def revalidate_in_background(self):
+        with self.meta.refresh_lock:
+            if self.meta.revalidating:
+                return False
+            self.meta.revalidating=True
+        threading.Thread(target=type(self).revalidate, args=(self,), name='prefy-revalidate', daemon=True).start()
+        return True
+
+    def revalidate(self):
+        try:
+            type(self).refresh(self, force_update=True)
+        except Exception as e:
+            logging.warning("{} - Could not refresh the settings of directory '{}'.".format(e,self.meta.directory_path))
+        finally:
+            self.meta.revalidating=False
+
     def __repr__(self):
         # Filter out special methods and only include regular attributes
-        attributes = ", ".join(f"{key}={value}" for key, value in vars(self).items() 
+        attrs = dict(vars(self))
+        attrs.update(self.meta.snapshot.updateable_values)
+        attrs.update(self.meta.snapshot.lazy_values)
+        attributes = ", ".join(f"{key}={value}" for key, value in attrs.items() 
                               if not (key.startswith('__') and key.endswith('__')))
         return f"{{{attributes}}}"
      
-    def __getattribute__(self,name):
-        try:
-            if name != 'meta' and name != 'check_attribute_updateable' and self.meta.instantiated==True:
-                self.check_attribute_updateable(name)
-            return super().__getattribute__(name)
-        except Exception as e:
-            logging.warning("{} - Unknown attribute with name '{}'. Add an element with this key to the list of attributes in a JSON file within directory '{}'.".format(e,name,self.meta.directory_path))
-            if self.allow_missing_attributes:
-                return None
-            else:
-                raise AttributeError
+    def __getattr__(self,name):
+        # Only called when regular lookup fails: plain settings live in __dict__ and never get here.
+        # What is left is the updateable settings and the missing attributes.
+        meta=self.__dict__.get('meta')
+        if meta is None or (name.startswith('__') and name.endswith('__')):
+            raise AttributeError(name)
+        if name in meta.snapshot.updateable_fields:
+            if meta.instantiated and meta.refresh_on_read:
+                try:
+                    type(self).check_attribute_updateable(self, name)
+                except Exception as e:
+                    logging.warning("{} - Could not refresh the settings of directory '{}'. Returning the last known value of '{}'.".format(e,meta.directory_path,name))
+        # Read the published snapshot once. It also covers plain keys while a refresh updates the instance's __dict__.
+        snapshot=meta.snapshot
+        if name in snapshot.values:
+            value=snapshot.get(name)
+            if value is not None or name not in snapshot.lazy_values: #Lazy .txt files that cannot be read are missing
+                return value
+        return type(self).missing_attribute(self, name)
+
+    def missing_attribute(self, name):
+        logging.warning("Unknown attribute with name '{}'. Add an element with this key to the list of attributes in a JSON file within directory '{}'.".format(name,self.meta.directory_path))
+        if self.__dict__.get('allow_missing_attributes', False):
+            return None
+        else:
+            raise AttributeError(name)
 
 class CollectionItem:
-    def __init__(self, name:str, preferences:Preferences):
+    def __init__(self, name:str, preferences:Preferences=None, directory_path=None, collection=None):
         self.name = name
-        self.preferences = preferences
+        self.directory_path = directory_path
+        self.collection = collection #Loads the preferences on first access in lazy collections
+        self._preferences = preferences
+
+    @property
+    def preferences(self):
+        if self.collection is not None:
+            return self.collection.load_item(self) #Also marks it as recently used, under the collection's lock
+        return self._preferences
+
+    @preferences.setter
+    def preferences(self, preferences):
+        self._preferences = preferences
+
+    @property
+    def loaded(self):
+        return self._preferences is not None
 
 class PreferencesCollection:
-    def __init__(self, directory_path,allow_missing_attributes=False):
+    def __init__(self, directory_path,allow_missing_attributes=False,watch=False,on_change=None,lazy=False,max_loaded=None,workers=None,executor=THREAD,share_parsed_files=False):
+        # watch: if True, a single background watcher keeps every Preferences of the collection up to date
+        # on_change: called with the name of the Preferences object and the set of changed keys
+        # lazy: if True, only the subdirectory names are indexed here and each Preferences is loaded the first time it is accessed
+        # max_loaded: in lazy mode, maximum number of Preferences kept in memory. The least recently used ones are evicted.
+        # workers/executor: if workers is greater than 1, the subdirectories are loaded in parallel with a 'thread' or 'process' pool
+        # share_parsed_files: if True, subdirectories containing identical files share their parsed values (see Preferences)
         if not os.path.isdir(directory_path):
             logging.error("Invalid directory: '{}'.".format(directory_path))
             raise OSError("Invalid directory: '{}'.".format(directory_path))
+        if max_loaded is not None and max_loaded < 1:
+            logging.error("Invalid max_loaded: '{}'. At least one Preferences object must be kept loaded.".format(max_loaded))
+            raise ValueError("Invalid max_loaded: '{}'. At least one Preferences object must be kept loaded.".format(max_loaded))
+        check_shared_executor(share_parsed_files, workers, executor)
         
+        self.allow_missing_attributes = allow_missing_attributes
+        self.on_change = on_change
+        self.lazy = lazy
+        self.max_loaded = max_loaded
+        self.share_parsed_files = share_parsed_files
+        self.watcher=None
+        self.lock = threading.RLock()
+        self.loaded = OrderedDict() #Names of the loaded items, least recently used first
         self.items: list[CollectionItem] = []
+        self.index: dict[str, CollectionItem] = {}
         # Get all subdirectories in the parent directory
         for directory in [os.path.join(directory_path, d) for d in os.listdir(directory_path) if os.path.isdir(os.path.join(directory_path, d))]:
             if not os.path.isdir(directory):
                 logging.error("Invalid directory: '{}'.".format(directory))
                 raise OSError("Invalid directory: '{}'.".format(directory))
             
-            preferences = Preferences(directory_path=directory,allow_missing_attributes=allow_missing_attributes)
             name = os.path.basename(directory)
-            item=CollectionItem(name, preferences)
+            item=CollectionItem(name, directory_path=directory, collection=self)
             self.items.append(item)
+            self.index[name]=item
+
+        if not lazy:
+            self.load_all(workers=workers, executor=executor)
+        if watch:
+            self.watch()
+
+    def load_all(self, workers=None, executor=THREAD):
+        # Loads every item not loaded yet, in parallel when workers is greater than 1
+        items=[item for item in self.items if not item.loaded]
+        if not workers or workers <= 1 or len(items) <= 1:
+            for item in items:
+                self.load_item(item)
+        elif executor == PROCESS or isinstance(executor, ProcessPoolExecutor):
+            # Preferences objects stay in this process: the workers only read and parse the files
+            entries=run_in_executor(scan_directory, [[item.directory_path for item in items]], workers, executor)
+            for item, file_entries in zip(items, entries):
+                self.load_item(item, file_entries)
+        else:
+            run_in_executor(self.load_item, [items], workers, executor)
+
+    def load_item(self, item, file_entries=None):
+        # Returns the Preferences of an item, instantiating it if needed and evicting the least recently used ones beyond max_loaded
+        with self.lock:
+            preferences = item._preferences
+            if preferences is not None:
+                self.touch(item)
+                return preferences
+        # Instantiated outside the lock so that loading one item does not block the others
+        loaded = Preferences(directory_path=item.directory_path,allow_missing_attributes=self.allow_missing_attributes,file_entries=file_entries,
+                             share_parsed_files=self.share_parsed_files)
+        with self.lock:
+            if item._preferences is None: #Not loaded by another thread in the meantime, or evicted since
+                if self.on_change is not None:
+                    type(loaded).subscribe(loaded, lambda changed, name=item.name: self.on_change(name, changed))
+                if self.watcher is not None:
+                    self.watcher.add(loaded)
+                    loaded.meta.refresh_on_read=False
+                item._preferences = loaded
+            preferences = item._preferences
+            self.touch(item)
+            if self.lazy and self.max_loaded is not None:
+                while len(self.loaded) > self.max_loaded:
+                    _, evicted = self.loaded.popitem(last=False)
+                    self.evict(evicted)
+            return preferences
+
+    def touch(self, item):
+        # Marks an item as the most recently used one
+        if self.lazy:
+            with self.lock:
+                self.loaded[item.name]=item
+                self.loaded.move_to_end(item.name)
+
+    def evict(self, item):
+        with self.lock:
+            if item._preferences is not None and self.watcher is not None:
+                # Callers still holding the evicted instance get its force_update settings refreshed on read again
+                self.watcher.remove(item._preferences)
+                item._preferences.meta.refresh_on_read=True
+            item._preferences = None
+            self.loaded.pop(item.name, None)
+
+    def loaded_items(self):
+        return [item for item in self.items if item.loaded]
+
+    def watch(self, debounce=DEFAULT_DEBOUNCE, poll_interval=DEFAULT_POLL_INTERVAL):
+        # Watches all the loaded directories of the collection from a single background thread
+        from .watcher import Watcher
+        with self.lock:
+            if self.watcher is None:
+                self.watcher=Watcher(debounce=debounce, poll_interval=poll_interval)
+                for item in self.loaded_items():
+                    self.watcher.add(item._preferences)
+                    item._preferences.meta.refresh_on_read=False
+                self.watcher.start()
+            return self.watcher
+
+    def stop_watching(self):
+        with self.lock:
+            if self.watcher is not None:
+                self.watcher.stop()
+                self.watcher=None
+                for item in self.loaded_items():
+                    item._preferences.meta.refresh_on_read=True
 
     def get_by_name(self, name):
         # Return a specific Preferences object by name
-        for item in self.items:
-            if item.name == name:
-                return item.preferences
+        item = self.index.get(name)
+        if item is not None:
+            return item.preferences
         logging.error("Preferences object not found with name '{}'.".format(name))
         raise KeyError("Preferences object not found with name '{}'.".format(name))
 
@@ -263,13 +900,379 @@ def check_boolean_property_value(object,key):
     else:
         return False
 
+def file_fingerprint(filepath):
+    # Cheap identity of a file's current content, used to skip files that did not change
+    stat=os.stat(filepath)
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino, stat.st_dev)
+
+def has_fingerprint(filepath, fingerprint):
+    try:
+        return fingerprint is not None and file_fingerprint(filepath) == fingerprint
+    except FileNotFoundError:
+        return False
+
+def txt_file_key(file_name):
+    # Extract key from the file name
+    base_name = os.path.basename(file_name)
+    return base_name.split('_', 1)[-1].replace(' ', '_').lower().replace('.txt', '')
+
+def merge_file_entries(file_names, file_entries):
+    # Merges the parsed files in the given (alphabetical) order into a MergedSettings
+    values={}
+    updateable={}
+    max_ages={}
+    sources={}
+    files_loaded=0
+    for file_name in file_names:
+        entry=file_entries.get(file_name)
+        if entry is None or entry.status != LOADED:
+            continue
+        files_loaded +=1
+        for position, (key, value, force_update, internal, max_age) in enumerate(entry.records):
+            sources.setdefault(key, []).append((file_name, position))
+            # Only the last definition of a setting decides whether it is updateable
+            updateable[key]=force_update
+            max_ages[key]=max_age
+            if not internal:
+                values[key]=value
+    updateable_fields={key for key, force_update in updateable.items() if force_update}
+    max_ages={key: max_age for key, max_age in max_ages.items() if key in updateable_fields and max_age is not None}
+    sources={key: tuple(positions) for key, positions in sources.items()}
+    return MergedSettings(values, updateable_fields, max_ages, files_loaded, sources)
+
+def copy_value(value):
+    return copy.deepcopy(value) if isinstance(value, (list, dict)) else value
+
+def same_value(previous, current):
+    # Unlike ==, tells 1 from True and 1.0, including inside lists and dicts
+    if type(previous) is not type(current):
+        return False
+    if isinstance(previous, list):
+        return len(previous) == len(current) and all(same_value(a, b) for a, b in zip(previous, current))
+    if isinstance(previous, dict):
+        return previous.keys() == current.keys() and all(same_value(value, current[key]) for key, value in previous.items())
+    return previous == current
+
+def same_file_entries(previous, current):
+    return previous.keys() == current.keys() and all(previous[file_name] is entry for file_name, entry in current.items())
+
+def read_compiled_file(compiled_path, directory_path):
+    # Returns the CompiledSettings stored in compiled_path, or None if it is missing, unreadable or built for another directory
+    try:
+        with open(compiled_path, 'rb') as file:
+            compiled=pickle.load(file)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        logging.warning("{} - Ignoring unreadable compiled settings '{}'.".format(e,compiled_path))
+        return None
+    if not isinstance(compiled, CompiledSettings) or getattr(compiled, 'version', None) != COMPILED_VERSION \
+            or compiled.directory_path != os.path.abspath(directory_path):
+        return None
+    return compiled
+
+def write_compiled_file(compiled_path, compiled):
+    # Writes to a temporary file first so that concurrent readers never see a partial file
+    temp_path='{}.{}.tmp'.format(compiled_path, os.getpid())
+    try:
+        with open(temp_path, 'wb') as file:
+            pickle.dump(compiled, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, compiled_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+def scan_settings_file(filepath,previous_fingerprint=None,shared=False,lazy_text=False):
+    # Parses a file unless its fingerprint is unchanged. Returns None if the file was removed in the meantime.
+    # With shared=True, the file is parsed through the process-wide PARSE_CACHE.
+    # With lazy_text=True, .txt files are not read: their key is registered with a LazyText value.
+    try:
+        fingerprint=file_fingerprint(filepath)
+    except FileNotFoundError:
+        return None
+    if fingerprint == previous_fingerprint:
+        return UNCHANGED
+    if lazy_text and filepath.endswith('.txt'):
+        return FileEntry(fingerprint, LOADED, [(txt_file_key(filepath), LazyText(filepath, fingerprint), False, False, None)], deferred=True)
+    if shared:
+        return PARSE_CACHE.parse(filepath,fingerprint)
+    return parse_settings_file(filepath,fingerprint)
+
+def scan_directory(directory_path):
+    # Parses all the settings files of a directory. Used to load directories in worker processes.
+    try:
+        file_names=[f for f in os.listdir(directory_path) if f.endswith('.json') or f.endswith('.txt')]
+    except OSError: #Reported by the Preferences constructor, like in the serial path
+        return {}
+    entries={}
+    for file_name in file_names:
+        entry=scan_settings_file(os.path.join(directory_path,file_name))
+        if entry is not None:
+            entries[file_name]=entry
+    return entries
+
+def check_shared_executor(share_parsed_files, workers, executor):
+    # Files parsed by worker processes would be cached in those processes, out of reach of this process' PARSE_CACHE
+    if share_parsed_files and workers and workers > 1 and (executor == PROCESS or isinstance(executor, ProcessPoolExecutor)):
+        logging.error("share_parsed_files cannot be combined with a process executor. Use a thread executor instead.")
+        raise ValueError("share_parsed_files cannot be combined with a process executor. Use a thread executor instead.")
+
+def run_in_executor(function, arguments, workers, executor=THREAD):
+    # Maps function over the argument lists with a pool of workers, preserving the order of the results
+    if isinstance(executor, Executor):
+        return list(executor.map(function, *arguments))
+    if executor == PROCESS:
+        pool=ProcessPoolExecutor(max_workers=workers)
+    elif executor == THREAD:
+        pool=ThreadPoolExecutor(max_workers=workers)
+    else:
+        raise ValueError("Unknown executor: '{}'.".format(executor))
+    with pool:
+        return list(pool.map(function, *arguments))
+
+def parse_settings_file(filepath,fingerprint=None):
+    # Reads a .txt or .json settings file into a FileEntry
+    if fingerprint is None:
+        fingerprint=file_fingerprint(filepath)
+    started=time.perf_counter()
+    data=read_file(filepath)
+    read=time.perf_counter()
+    entry=parse_settings_data(filepath,data,fingerprint)
+    entry.read_time=read-started
+    entry.parse_time=time.perf_counter()-read
+    return entry
+
+def read_file(filepath):
+    with open(filepath, 'rb') as file:
+        return file.read()
+
+def read_text_file(filepath):
+    # Reads the content of a .txt file, decoded as parse_settings_data would
+    return decode_text(read_file(filepath)).strip()
+
+def decode_text(data):
+    # Same decoding as reading the file in text mode: locale encoding and universal newlines
+    return data.decode(locale.getpreferredencoding(False)).replace('\r\n', '\n').replace('\r', '\n')
+
+def likely_deactivated(text):
+    # Cheap pre-check telling whether a record holding the deactivation key also holds a true value
+    needle='"{}"'.format(DEACTIVATE)
+    position=text.find(needle)
+    while position != -1:
+        end=text.find('}', position)
+        if DEACTIVATION_VALUE.search(text, text.rfind('{', 0, position)+1, end if end != -1 else len(text)):
+            return True
+        position=text.find(needle, position+len(needle))
+    return False
+
+def parse_settings_data(filepath,data,fingerprint,intern=None):
+    # Parses the raw content of a .txt or .json settings file into a FileEntry.
+    # intern, if given, is applied to the keys and string values.
+    intern=intern or (lambda value: value)
+    if filepath.endswith('.txt'):
+        content = decode_text(data).strip()
+        return FileEntry(fingerprint, LOADED, [(intern(txt_file_key(filepath)), intern(content), False, False, None)])
+
+    text=decode_text(data)
+    try:
+        if likely_deactivated(text):
+            # Parse the records one at a time to stop at the deactivation record
+            data=streaming.iter_array(text)
+        else:
+            # Most likely active: parse it at once, with the faster backend when it is installed.
+            # settings_records still catches deactivation records the pre-check missed.
+            data=streaming.loads(text)
+            if not isinstance(data, list):
+                raise json.JSONDecodeError("Expecting a list of settings", text, 0)
+        records=settings_records(data, intern)
+    except json.JSONDecodeError:
+        logging.warning("Invalid JSON format in file '{}'.".format(filepath))
+        return FileEntry(fingerprint, INVALID)
+    
+    # Check if the file should be skipped
+    if records is None:
+        return FileEntry(fingerprint, DEACTIVATED)
+    return FileEntry(fingerprint, LOADED, records)
+
+def settings_records(data, intern):
+    # Converts the settings objects of a file into records. Returns None as soon as a deactivation record is found.
+    # TODO: Add logic to prevent overwriting existing settings when restricted=true 
+    records=[]
+    for record in data:
+        if record.get(KEY) == DEACTIVATE and record.get(VALUE) == True:
+            return None
+        records.append((intern(record.get(KEY)), intern(record.get(VALUE)), bool(check_boolean_property_value(record,FORCE_FIELD_UPDATE)), record.get(TYPE) == INTERNAL_SETTINGS, check_max_age(record.get(MAX_AGE))))
+    return records
+
+def check_max_age(value):
+    # Record-level max_age, in milliseconds. Numeric strings are accepted; other values fall back to the instance's max_age.
+    if value is None or (isinstance(value, (int, float)) and not isinstance(value, bool)):
+        return value
+    try:
+        if isinstance(value, str):
+            return float(value)
+    except ValueError:
+        pass
+    logging.warning("Invalid max_age '{}', using the max_age of the Preferences instance instead.".format(value))
+    return None
+
+class ParseCache:
+    # Process-wide cache of parsed settings files, shared by the Preferences instances created with share_parsed_files=True.
+    # Files are looked up by identity (device, inode, mtime and size), which covers symlinks and hard links without reading them,
+    # then by a hash of their content, which covers copies. Matching files share the same parsed records and values,
+    # and the keys and string values of all the parsed files are interned.
+    def __init__(self, max_size=PARSE_CACHE_SIZE):
+        self.max_size=max_size
+        self.lock=threading.Lock()
+        self.by_identity=OrderedDict() #(fingerprint, txt key) -> (status, records)
+        self.by_content=OrderedDict() #(content hash, txt key) -> (status, records)
+        self.hits=0
+        self.misses=0
+
+    def parse(self, filepath, fingerprint):
+        # .txt records depend on the file name, so it is part of their keys
+        name_key=txt_file_key(filepath) if filepath.endswith('.txt') else None
+        identity=(fingerprint, name_key)
+        started=time.perf_counter()
+        with self.lock:
+            cached=self.get(self.by_identity, identity)
+        if cached is not None:
+            entry=FileEntry(fingerprint, cached[0], cached[1])
+            entry.reported=True #Nothing was read
+            return entry
+
+        data=read_file(filepath)
+        read=time.perf_counter()
+        content=(hashlib.sha1(data).digest(), name_key)
+        with self.lock:
+            cached=self.get(self.by_content, content)
+        if cached is None:
+            entry=parse_settings_data(filepath, data, fingerprint, intern=intern_value)
+            cached=(entry.status, entry.records)
+            with self.lock:
+                self.put(self.by_content, content, cached)
+        with self.lock:
+            self.put(self.by_identity, identity, cached)
+        return FileEntry(fingerprint, cached[0], cached[1], read_time=read-started, parse_time=time.perf_counter()-read)
+
+    def get(self, table, key):
+        cached=table.get(key)
+        if cached is None:
+            self.misses+=1
+        else:
+            self.hits+=1
+            table.move_to_end(key)
+        return cached
+
+    def put(self, table, key, value):
+        table[key]=value
+        table.move_to_end(key)
+        while len(table) > self.max_size:
+            table.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.by_identity.clear()
+            self.by_content.clear()
+
+def intern_value(value):
+    return sys.intern(value) if type(value) is str else value
+
+PARSE_CACHE=ParseCache()
+
+class RegistryEntry:
+    def __init__(self, preferences=None):
+        self.preferences=preferences
+        self.references=0
+        self.loaded=threading.Event() #Set once the first caller has loaded the instance, or failed to
+        self.error=None
+
+class PreferencesRegistry:
+    # Process-wide, thread-safe registry of shared Preferences instances, keyed by resolved directory path and options.
+    # acquire() returns the shared instance, loading it on first use; release() drops a reference; invalidate() makes
+    # the next acquire() load a fresh instance. Unused instances are kept until invalidate() so that objects created
+    # one after another do not reload the directory each time, unless keep_unused is False.
+    def __init__(self, keep_unused=True):
+        self.lock=threading.Lock()
+        self.entries={}
+        self.keep_unused=keep_unused
+
+    def key(self, directory_path, options):
+        return (os.path.realpath(directory_path), tuple(sorted(options.items())))
+
+    def acquire(self, directory_path=DEFAULT_DIR, **options):
+        key=self.key(directory_path, options)
+        with self.lock:
+            entry=self.entries.get(key)
+            loading=entry is None
+            if loading:
+                entry=self.entries[key]=RegistryEntry()
+            entry.references+=1
+        if not loading:
+            # Concurrent callers wait for the first one's load instead of loading the directory again
+            entry.loaded.wait()
+            if entry.error is not None:
+                raise entry.error
+            return entry.preferences
+        # Loaded outside the lock so that loading one directory does not block the others
+        try:
+            entry.preferences=Preferences(directory_path=directory_path, **options)
+        except Exception as e:
+            entry.error=e
+            with self.lock:
+                if self.entries.get(key) is entry:
+                    del self.entries[key]
+            raise
+        finally:
+            entry.loaded.set()
+        return entry.preferences
+
+    def release(self, preferences):
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if entry.preferences is preferences:
+                    entry.references-=1
+                    if entry.references <= 0 and not self.keep_unused:
+                        del self.entries[key]
+                    return
+
+    def invalidate(self, directory_path=None, **options):
+        # Forgets the instances of a directory (all of them when directory_path is None). Current holders keep theirs.
+        with self.lock:
+            if directory_path is None:
+                self.entries.clear()
+                return
+            path=os.path.realpath(directory_path)
+            for key in [key for key in self.entries if key[0] == path and (not options or key == self.key(directory_path, options))]:
+                del self.entries[key]
+
+    def references(self, preferences):
+        with self.lock:
+            return sum(entry.references for entry in self.entries.values() if entry.preferences is preferences)
+
+    def refresh(self, preferences):
+        # Concurrent refresh requests on a shared instance are served by a single refresh
+        requested_at=time.monotonic()
+        with preferences.meta.refresh_lock:
+            refreshed_at=preferences.meta.refreshed_at
+            if refreshed_at is not None and refreshed_at >= requested_at:
+                return set()
+            return type(preferences).refresh(preferences, force_update=True)
+
+PREFERENCES_REGISTRY=PreferencesRegistry()
+
 class PreferencesWrapper:
     #All classes should have a settings object
+    #Wrappers created without settings share the Preferences of their directory through PREFERENCES_REGISTRY
     def __init__(self, settings=None,directory_path=DEFAULT_DIR):
+        self.shared_settings = settings is None
         if settings is None:
-            settings=Preferences(directory_path=directory_path)
+            settings=PREFERENCES_REGISTRY.acquire(directory_path)
+            weakref.finalize(self, PREFERENCES_REGISTRY.release, settings)
             
         self.settings=settings
     
     def refresh_settings(self):
-        self.settings.refresh(force_update=True)
+        if self.shared_settings:
+            return PREFERENCES_REGISTRY.refresh(self.settings)
+        return self.settings.refresh(force_update=True)
@@ -0,0 +1,122 @@
+import os
+import glob
+import mmap
+import time
+import pickle
+import struct
+
+try:
+    import fcntl
+except ImportError: #Not available on Windows
+    fcntl = None
+
+#Layout of the control file: the generation of the latest published settings
+GENERATION=struct.Struct('Q')
+
+#How often, in seconds, readers check whether the writer process is gone and they should take over
+TAKEOVER_INTERVAL=1.0
+
+#Number of previous generations kept on disk for the readers still loading them
+KEPT_GENERATIONS=2
+
+
+class SharedStore:
+    # Settings store shared by the processes of a pre-fork deployment.
+    # One process, the writer, loads the settings files and publishes the merged settings to `path.<generation>`,
+    # then bumps the generation counter stored in the memory-mapped control file `path`. The other processes,
+    # the readers, check that counter in memory and only map and load the data file when it changed.
+    # The writer is elected with an exclusive lock on `path.lock`; when it exits, a reader takes over.
+    # The data files are unpickled: the store must live in a directory only the application's user can write to.
+    # Files are created readable by that user only, and data files owned by anyone else are refused.
+    def __init__(self, path, directory_path=None):
+        if fcntl is None:
+            raise OSError("Shared settings stores require fcntl, which is not available on this platform.")
+        self.path=path
+        self.directory_path=os.path.abspath(directory_path) if directory_path is not None else None #Settings directory the store is built from
+        self.is_writer=False
+        self.lock_fd=os.open(path + '.lock', os.O_RDWR | os.O_CREAT, 0o600)
+        control_fd=os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(control_fd).st_size < GENERATION.size:
+                os.ftruncate(control_fd, GENERATION.size)
+            self.control=mmap.mmap(control_fd, GENERATION.size)
+        finally:
+            os.close(control_fd)
+        self.loaded_generation=0
+        self.checked_takeover_at=time.monotonic()
+
+    def try_acquire_writer(self):
+        # Returns True if this process is (now) the writer
+        if not self.is_writer:
+            try:
+                fcntl.flock(self.lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                self.is_writer=True
+            except BlockingIOError:
+                pass
+        return self.is_writer
+
+    def should_take_over(self):
+        # Rate-limited check, for readers, of whether the writer is gone
+        now=time.monotonic()
+        if self.is_writer or now - self.checked_takeover_at < TAKEOVER_INTERVAL:
+            return False
+        self.checked_takeover_at=now
+        return self.try_acquire_writer()
+
+    @property
+    def generation(self):
+        # Read from the shared memory mapping, without any system call
+        return GENERATION.unpack_from(self.control, 0)[0]
+
+    def data_path(self, generation):
+        return '{}.{}'.format(self.path, generation)
+
+    def publish(self, merged):
+        # Writer only: stores the merged settings as the next generation
+        generation=self.generation + 1
+        temp_path='{}.tmp'.format(self.data_path(generation))
+        with os.fdopen(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'wb') as file:
+            pickle.dump((self.directory_path, merged), file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self.data_path(generation))
+        GENERATION.pack_into(self.control, 0, generation)
+        self.loaded_generation=generation
+        self.remove_old_generations(generation)
+        return generation
+
+    def remove_old_generations(self, generation):
+        for data_path in glob.glob(glob.escape(self.path) + '.*'):
+            suffix=data_path[len(self.path) + 1:]
+            if suffix.isdigit() and int(suffix) <= generation - KEPT_GENERATIONS:
+                try:
+                    os.remove(data_path)
+                except FileNotFoundError:
+                    pass
+
+    def read(self, force=False):
+        # Returns the merged settings of the latest generation, or None if nothing new was published since the last read
+        generation=self.generation
+        if generation == 0 or (generation == self.loaded_generation and not force):
+            return None
+        try:
+            with open(self.data_path(generation), 'rb') as file:
+                check_owner(file.fileno(), self.data_path(generation))
+                with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                    directory_path, merged=pickle.loads(mapped)
+        except FileNotFoundError: #Superseded while we were opening it
+            return self.read(force) if self.generation != generation else None
+        if directory_path != self.directory_path:
+            raise ValueError("Shared settings store '{}' holds the settings of directory '{}'.".format(self.path, directory_path))
+        self.loaded_generation=generation
+        return merged
+
+    def close(self):
+        self.control.close()
+        os.close(self.lock_fd) #Releases the writer lock
+        self.is_writer=False
+
+
+def check_owner(fd, path):
+    # Refuses files that another user could have written, since unpickling them would run their code
+    stat=os.fstat(fd)
+    if stat.st_uid != os.getuid() or stat.st_mode & 0o022:
+        raise PermissionError("Shared settings store file '{}' must be owned by the current user and not writable by others.".format(path))
@@ -0,0 +1,56 @@
+import json
+import re
+
+try: #Optional faster JSON backend
+    import orjson
+except ImportError:
+    orjson = None
+
+WHITESPACE = re.compile(r'[ \t\n\r]*') #Same as json.decoder, much faster than a loop over the characters
+DECODER = json.JSONDecoder()
+
+
+def loads(text):
+    # Parses a whole JSON document, with orjson when it is installed.
+    # orjson is stricter than json (e.g. it rejects NaN), so the standard parser gets the last word.
+    if orjson is not None:
+        try:
+            return orjson.loads(text)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(text)
+
+
+def iter_array(text):
+    # Yields the elements of a top-level JSON array one at a time, so that callers can stop early.
+    # Raises json.JSONDecodeError when the text is not a well-formed array, like json.loads would.
+    end = len(text)
+    position = skip_whitespace(text, 0)
+    if position >= end or text[position] != '[':
+        raise json.JSONDecodeError("Expecting '['", text, position)
+    position = skip_whitespace(text, position + 1)
+    if position < end and text[position] == ']':
+        check_trailing(text, position + 1)
+        return
+    while True:
+        element, position = DECODER.raw_decode(text, position)
+        yield element
+        position = skip_whitespace(text, position)
+        if position >= end:
+            raise json.JSONDecodeError("Expecting ',' delimiter", text, position)
+        if text[position] == ']':
+            check_trailing(text, position + 1)
+            return
+        if text[position] != ',':
+            raise json.JSONDecodeError("Expecting ',' delimiter", text, position)
+        position = skip_whitespace(text, position + 1)
+
+
+def skip_whitespace(text, position):
+    return WHITESPACE.match(text, position).end()
+
+
+def check_trailing(text, position):
+    position = skip_whitespace(text, position)
+    if position < len(text):
+        raise json.JSONDecodeError("Extra data", text, position)
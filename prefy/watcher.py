@@ -0,0 +1,196 @@
+import os
+import sys
+import time
+import struct
+import select
+import logging
+import threading
+import ctypes
+import ctypes.util
+
+from .prefy import DEFAULT_DEBOUNCE, DEFAULT_POLL_INTERVAL, file_fingerprint
+
+#inotify constants, from <sys/inotify.h>
+IN_MODIFY=0x00000002
+IN_ATTRIB=0x00000004
+IN_CLOSE_WRITE=0x00000008
+IN_MOVED_FROM=0x00000040
+IN_MOVED_TO=0x00000080
+IN_CREATE=0x00000100
+IN_DELETE=0x00000200
+IN_Q_OVERFLOW=0x00004000
+IN_WATCH_MASK=IN_MODIFY|IN_ATTRIB|IN_CLOSE_WRITE|IN_MOVED_FROM|IN_MOVED_TO|IN_CREATE|IN_DELETE
+EVENT_HEADER=struct.Struct('iIII')
+
+#How often the watcher thread checks whether it has been stopped, in seconds
+STOP_CHECK_INTERVAL=0.25
+
+
+class Inotify:
+    # Thin ctypes binding of the Linux inotify API
+    def __init__(self):
+        if not sys.platform.startswith('linux'):
+            raise OSError("inotify is only available on Linux.")
+        self.libc=ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd=self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed.")
+
+    def add_watch(self, directory_path):
+        wd=self.libc.inotify_add_watch(self.fd, os.fsencode(directory_path), IN_WATCH_MASK)
+        if wd < 0:
+            raise OSError(ctypes.get_errno(), "Cannot watch directory '{}'.".format(directory_path))
+        return wd
+
+    def remove_watch(self, wd):
+        self.libc.inotify_rm_watch(self.fd, wd)
+
+    def read_events(self, timeout):
+        # Returns a list of (wd, mask, name) tuples, empty if nothing happened within the timeout
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return []
+        try:
+            buffer=os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events=[]
+        offset=0
+        while offset < len(buffer):
+            wd, mask, _cookie, length = EVENT_HEADER.unpack_from(buffer, offset)
+            offset += EVENT_HEADER.size
+            name=buffer[offset:offset+length].rstrip(b'\0').decode(errors='replace')
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WatchedDirectory:
+    def __init__(self, preferences, wd=None):
+        self.preferences=preferences
+        self.wd=wd
+        self.fingerprints=directory_fingerprints(preferences.meta.directory_path)
+        self.pending_since=None #Time of the last change not applied yet
+
+
+class Watcher:
+    # Watches the directories of one or more Preferences instances and refreshes them in a background thread.
+    # Uses inotify where available and falls back to polling the files' fingerprints.
+    # Changes are debounced: a directory is refreshed once it has been quiet for `debounce` seconds.
+    def __init__(self, debounce=DEFAULT_DEBOUNCE, poll_interval=DEFAULT_POLL_INTERVAL, use_inotify=True):
+        self.debounce=debounce
+        self.poll_interval=poll_interval
+        self.directories=[]
+        self.lock=threading.Lock()
+        self.stopped=threading.Event()
+        self.thread=None
+        self.inotify=None
+        if use_inotify:
+            try:
+                self.inotify=Inotify()
+            except (OSError, AttributeError) as e:
+                logging.info("inotify unavailable ({}), polling settings directories every {}s.".format(e,poll_interval))
+
+    @property
+    def mode(self):
+        return 'inotify' if self.inotify is not None else 'polling'
+
+    def add(self, preferences):
+        wd=None
+        if self.inotify is not None:
+            wd=self.inotify.add_watch(preferences.meta.directory_path)
+        with self.lock:
+            self.directories.append(WatchedDirectory(preferences, wd))
+
+    def remove(self, preferences):
+        with self.lock:
+            for directory in [d for d in self.directories if d.preferences is preferences]:
+                self.directories.remove(directory)
+                if directory.wd is not None and all(d.wd != directory.wd for d in self.directories):
+                    self.inotify.remove_watch(directory.wd)
+
+    def start(self):
+        if self.thread is None:
+            self.thread=threading.Thread(target=self.run, name='prefy-watcher', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread=None
+        if self.inotify is not None:
+            self.inotify.close()
+            self.inotify=None
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                if self.inotify is not None:
+                    self.wait_for_events()
+                else:
+                    self.stopped.wait(self.next_timeout(self.poll_interval))
+                    self.poll()
+                self.apply_pending()
+            except Exception as e:
+                logging.error('Error {} in settings watcher.'.format(e))
+
+    def next_timeout(self, idle_timeout):
+        # Wakes up in time to apply pending changes once they are debounced
+        with self.lock:
+            pending=[d.pending_since for d in self.directories if d.pending_since is not None]
+        if not pending:
+            return idle_timeout
+        return max(0, min(pending) + self.debounce - time.monotonic())
+
+    def wait_for_events(self):
+        events=self.inotify.read_events(self.next_timeout(STOP_CHECK_INTERVAL))
+        now=time.monotonic()
+        with self.lock:
+            for wd, mask, name in events:
+                for directory in self.directories:
+                    if mask & IN_Q_OVERFLOW or (directory.wd == wd and is_settings_file(name)):
+                        directory.pending_since=now
+
+    def poll(self):
+        now=time.monotonic()
+        with self.lock:
+            directories=list(self.directories)
+        for directory in directories:
+            try:
+                fingerprints=directory_fingerprints(directory.preferences.meta.directory_path)
+            except OSError:
+                continue
+            if fingerprints != directory.fingerprints:
+                directory.fingerprints=fingerprints
+                directory.pending_since=now
+
+    def apply_pending(self):
+        now=time.monotonic()
+        with self.lock:
+            due=[d for d in self.directories if d.pending_since is not None and now - d.pending_since >= self.debounce]
+            for directory in due:
+                directory.pending_since=None
+        for directory in due:
+            try:
+                type(directory.preferences).refresh(directory.preferences, force_update=True)
+            except Exception as e:
+                logging.warning("{} - Could not refresh the settings of directory '{}'.".format(e,directory.preferences.meta.directory_path))
+
+
+def is_settings_file(file_name):
+    return file_name.endswith('.json') or file_name.endswith('.txt')
+
+def directory_fingerprints(directory_path):
+    # Fingerprint of every settings file of a directory, used by the polling mode
+    fingerprints={}
+    for file_name in os.listdir(directory_path):
+        if is_settings_file(file_name):
+            try:
+                fingerprints[file_name]=file_fingerprint(os.path.join(directory_path, file_name))
+            except FileNotFoundError:
+                pass
+    return fingerprints
@@ -2,11 +2,29 @@ import shutil
 import unittest
 import os
 import json
+import time
+import threading
+import asyncio
+import pickle
+from unittest import mock
 
-from prefy.prefy import Preferences, PreferencesCollection
+from prefy import prefy
+from prefy.prefy import Preferences, PreferencesCollection, PreferencesWrapper, PREFERENCES_REGISTRY
+from prefy.watcher import Watcher
+from prefy.metrics import PreferencesHooks
+from prefy import streaming, shared
+from prefy.aio import AsyncPreferences, AsyncPreferencesCollection
 
 TEST_DIR_PATH='temp'
 
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
 class TestSettings(unittest.TestCase):
     def setUp(self):
         os.makedirs(TEST_DIR_PATH, exist_ok=True)
@@ -94,6 +112,81 @@ class TestSettings(unittest.TestCase):
         with self.assertRaises(AttributeError):
             result.inexisting_setting
      
+    def test_incremental_refresh(self):
+        json_file1 = os.path.join(TEST_DIR_PATH, "1.base.json")
+        json_file2 = os.path.join(TEST_DIR_PATH, "2.override.json")
+        with open(json_file1, "w") as file:
+            json.dump([{"key": "color", "value": "blue"}, {"key": "size", "value": 1}], file)
+        with open(json_file2, "w") as file:
+            json.dump([{"key": "color", "value": "red"}, {"key": "shape", "value": "square"}], file)
+
+        result = Preferences(TEST_DIR_PATH)
+        self.assertEqual(result.color, "red")
+        base_entry = result.meta.file_entries["1.base.json"]
+
+        # Unchanged files are not parsed again
+        result.refresh()
+        self.assertIs(result.meta.file_entries["1.base.json"], base_entry)
+
+        # Keys of a deactivated file are retracted and the previous layer shows through
+        with open(json_file2, "w") as file:
+            json.dump([{"key": "deactivate_setting_file", "value": True, "type": "Prefy"},
+                       {"key": "color", "value": "red"}, {"key": "shape", "value": "square"}], file)
+        result.refresh()
+        self.assertIs(result.meta.file_entries["1.base.json"], base_entry)
+        self.assertEqual(result.color, "blue")
+        with self.assertRaises(AttributeError):
+            result.shape
+
+        # Keys of a deleted file are retracted
+        with open(os.path.join(TEST_DIR_PATH, "3_note.txt"), "w") as file:
+            file.write("Some note")
+        result.refresh()
+        self.assertEqual(result.note, "Some note")
+        os.remove(os.path.join(TEST_DIR_PATH, "3_note.txt"))
+        result.refresh()
+        with self.assertRaises(AttributeError):
+            result.note
+
+        # Mutating a list setting does not alter the cached parse, and the next refresh restores the file's content
+        with open(json_file1, "w") as file:
+            json.dump([{"key": "color", "value": "blue"}, {"key": "items", "value": [1, 2]}], file)
+        result.refresh()
+        result.items.append(99)
+        self.assertEqual(result.meta.file_entries["1.base.json"].records[1][1], [1, 2])
+        result.refresh()
+        self.assertEqual(result.items, [1, 2])
+
+    def test_updateable_fields_access(self):
+        json_file = os.path.join(TEST_DIR_PATH, "1.settings.json")
+        with open(json_file, "w") as file:
+            json.dump([{"key": "plain", "value": 1}, {"key": "live", "value": 1, "force_update": True}], file)
+
+        result = Preferences(TEST_DIR_PATH)
+        self.assertEqual(result.meta.updateable_fields, {"live"})
+        self.assertIn("plain", vars(result))
+        self.assertNotIn("live", vars(result))
+        self.assertEqual(dict(result)["live"], 1)
+
+        # Once the setting stops being updateable, it is served as a plain attribute
+        with open(json_file, "w") as file:
+            json.dump([{"key": "plain", "value": 1}, {"key": "live", "value": 2, "force_update": False}], file)
+        self.assertEqual(result.live, 2)
+        self.assertEqual(result.meta.updateable_fields, set())
+        self.assertEqual(vars(result)["live"], 2)
+
+        # Switching between equal values of different types is a change, including inside lists
+        with open(json_file, "w") as file:
+            json.dump([{"key": "plain", "value": True}, {"key": "live", "value": 0, "force_update": True},
+                       {"key": "items", "value": [1, 0]}], file)
+        result.refresh()
+        with open(json_file, "w") as file:
+            json.dump([{"key": "plain", "value": 1}, {"key": "live", "value": False, "force_update": True},
+                       {"key": "items", "value": [True, False]}], file)
+        self.assertIs(result.live, False)
+        self.assertIs(result.plain, 1)
+        self.assertIs(result.items[0], True)
+
     def test_only_kwargs_passed(self):        
             result = Preferences(bypass_directory=True, ad_hoc_prefs={"system_instructions":"Test system instructions",
     "user_prompt":"Test user prompt","str_output_parser":'UnsupportedParser'})
@@ -161,5 +254,714 @@ class TestSettings(unittest.TestCase):
             disallowed_missing_attributes.non_existent_attribute # Passing a non-string directory path
 
 
+    def test_watch_mode(self):
+        json_file = os.path.join(TEST_DIR_PATH, "1.settings.json")
+        with open(json_file, "w") as file:
+            json.dump([{"key": "live", "value": "old", "force_update": True}, {"key": "plain", "value": 1}], file)
+
+        for use_inotify in (True, False):
+            changes = []
+            result = Preferences(TEST_DIR_PATH, on_change=changes.append)
+            watcher = Watcher(debounce=0.01, poll_interval=0.01, use_inotify=use_inotify)
+            watcher.add(result)
+            result.meta.refresh_on_read = False
+            watcher.start()
+            try:
+                with open(json_file, "w") as file:
+                    json.dump([{"key": "live", "value": "new", "force_update": True}, {"key": "plain", "value": 1}], file)
+                self.assertTrue(wait_for(lambda: changes), "No change applied in {} mode".format(watcher.mode))
+                self.assertEqual(changes[0], {"live"})
+                self.assertEqual(result.live, "new")
+            finally:
+                watcher.stop()
+            with open(json_file, "w") as file:
+                json.dump([{"key": "live", "value": "old", "force_update": True}, {"key": "plain", "value": 1}], file)
+
+    def test_watch_mode_reads_do_not_refresh(self):
+        json_file = os.path.join(TEST_DIR_PATH, "1.settings.json")
+        with open(json_file, "w") as file:
+            json.dump([{"key": "live", "value": "old", "force_update": True}], file)
+        result = Preferences(TEST_DIR_PATH, watch=True)
+        try:
+            result.meta.watcher.stop() # Simulates a change the watcher has not applied yet
+            with open(json_file, "w") as file:
+                json.dump([{"key": "live", "value": "new", "force_update": True}], file)
+            self.assertEqual(result.live, "old")
+        finally:
+            result.stop_watching()
+        self.assertEqual(result.live, "new")
+
+    def test_max_age(self):
+        json_file = os.path.join(TEST_DIR_PATH, "1.settings.json")
+        with open(json_file, "w") as file:
+            json.dump([{"key": "live", "value": "old", "force_update": True},
+                       {"key": "cached", "value": "old", "force_update": True, "max_age": 60000}], file)
+        result = Preferences(TEST_DIR_PATH, max_age=100)
+        with open(json_file, "w") as file:
+            json.dump([{"key": "live", "value": "new", "force_update": True},
+                       {"key": "cached", "value": "new", "force_update": True, "max_age": 60000}], file)
+
+        # Within the window, reads are served from memory
+        self.assertEqual(result.live, "old")
+        time.sleep(0.15)
+        # The record's own max_age overrides the instance's one
+        self.assertEqual(result.cached, "old")
+        self.assertEqual(result.live, "new")
+        self.assertEqual(result.meta.max_ages, {"cached": 60000})
+
+        # Numeric strings are accepted as max_age, other values fall back to the instance's one
+        with open(json_file, "w") as file:
+            json.dump([{"key": "live", "value": "new", "force_update": True, "max_age": "soon"},
+                       {"key": "cached", "value": "new", "force_update": True, "max_age": "60000"}], file)
+        with self.assertLogs(level="WARNING"):
+            result = Preferences(TEST_DIR_PATH, max_age=100)
+        self.assertEqual(result.meta.max_ages, {"cached": 60000})
+        self.assertEqual(result.live, "new")
+
+    def test_concurrent_reads_share_one_refresh(self):
+        json_file = os.path.join(TEST_DIR_PATH, "1.settings.json")
+        with open(json_file, "w") as file:
+            json.dump([{"key": "live", "value": "old", "force_update": True}], file)
+
+        refreshes = []
+        class SlowPreferences(Preferences):
+            def load_files(self):
+                refreshes.append(1)
+                time.sleep(0.05)
+                super().load_files()
+
+        result = SlowPreferences(TEST_DIR_PATH)
+        refreshes.clear()
+        readers = [threading.Thread(target=lambda: result.live) for _ in range(10)]
+        for reader in readers:
+            reader.start()
+        for reader in readers:
+            reader.join()
+        self.assertLessEqual(len(refreshes), 2)
+
+    def test_stale_while_revalidate(self):
+        json_file = os.path.join(TEST_DIR_PATH, "1.settings.json")
+        with open(json_file, "w") as file:
+            json.dump([{"key": "live", "value": "old", "force_update": True}], file)
+        class SlowPreferences(Preferences):
+            def load_files(self):
+                if self.meta.instantiated:
+                    time.sleep(0.05)
+                super().load_files()
+
+        result = SlowPreferences(TEST_DIR_PATH, stale_while_revalidate=True)
+        with open(json_file, "w") as file:
+            json.dump([{"key": "live", "value": "new", "force_update": True}], file)
+
+        self.assertEqual(result.live, "old")
+        self.assertTrue(wait_for(lambda: result.live == "new"))
+
+    def test_lazy_preferences_collection(self):
+        names = ['tenant{}'.format(i) for i in range(5)]
+        for name in names:
+            os.makedirs(os.path.join(TEST_DIR_PATH, name), exist_ok=True)
+            with open(os.path.join(TEST_DIR_PATH, name, "settings.json"), "w") as file:
+                json.dump([{"key": "tenant", "value": name}], file)
+
+        collection = PreferencesCollection(TEST_DIR_PATH, lazy=True, max_loaded=2)
+        self.assertEqual(set(collection.list_names()), set(names))
+        self.assertEqual(collection.loaded_items(), [])
+
+        self.assertEqual(collection.get_by_name('tenant1').tenant, 'tenant1')
+        self.assertEqual(collection.get_by_name('tenant2').tenant, 'tenant2')
+        collection.get_by_name('tenant1')
+        self.assertEqual(collection.get_by_name('tenant3').tenant, 'tenant3')
+        # tenant2 was the least recently used one
+        self.assertEqual({item.name for item in collection.loaded_items()}, {'tenant1', 'tenant3'})
+        self.assertEqual(collection.get_by_name('tenant2').tenant, 'tenant2')
+        self.assertEqual(len(collection.loaded_items()), 2)
+
+        with self.assertRaises(KeyError):
+            collection.get_by_name('unknown')
+        with self.assertRaises(ValueError):
+            PreferencesCollection(TEST_DIR_PATH, lazy=True, max_loaded=0)
+
+        # Concurrent reads never see an item evicted by another thread
+        contended = PreferencesCollection(TEST_DIR_PATH, lazy=True, max_loaded=1)
+        results = []
+        def read_tenants():
+            for i in range(200):
+                results.append(contended.get_by_name(names[i % 4]))
+        threads = [threading.Thread(target=read_tenants) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 1600)
+        self.assertNotIn(None, results)
+
+        # Evicted instances are no longer watched and refresh on read again
+        watched = PreferencesCollection(TEST_DIR_PATH, lazy=True, max_loaded=1, watch=True)
+        try:
+            tenant0 = watched.get_by_name('tenant0')
+            self.assertFalse(tenant0.meta.refresh_on_read)
+            watched.get_by_name('tenant1')
+            self.assertTrue(tenant0.meta.refresh_on_read)
+        finally:
+            watched.stop_watching()
+
+    def test_parallel_loading(self):
+        for i in range(3):
+            directory = os.path.join(TEST_DIR_PATH, "dir{}".format(i))
+            os.makedirs(directory, exist_ok=True)
+            for j in range(4):
+                with open(os.path.join(directory, "{}.settings.json".format(j)), "w") as file:
+                    json.dump([{"key": "shared", "value": "{}-{}".format(i, j)}, {"key": "key_{}".format(j), "value": j}], file)
+            with open(os.path.join(directory, "9_prompt.txt"), "w") as file:
+                file.write("Prompt {}".format(i))
+
+        serial = PreferencesCollection(TEST_DIR_PATH)
+        for executor in ("thread", "process"):
+            parallel = PreferencesCollection(TEST_DIR_PATH, workers=2, executor=executor)
+            self.assertEqual(parallel.list_names(), serial.list_names())
+            for expected, item in zip(serial, parallel):
+                self.assertEqual(dict(item.preferences), dict(expected.preferences))
+                # Files parsed by the workers are reported like the others
+                metrics = item.preferences.meta.metrics.as_dict()
+                self.assertEqual(metrics["files_read"], 5)
+                self.assertEqual(metrics["bytes_read"], expected.preferences.meta.metrics.bytes_read)
+
+            directory = os.path.join(TEST_DIR_PATH, "dir0")
+            self.assertEqual(dict(Preferences(directory, workers=2, executor=executor)), dict(Preferences(directory)))
+
+        # Invalid subdirectories fail the same way as in the serial path
+        os.makedirs(os.path.join(TEST_DIR_PATH, "empty"))
+        for executor in ("thread", "process"):
+            with self.assertRaises(FileNotFoundError):
+                PreferencesCollection(TEST_DIR_PATH, workers=2, executor=executor)
+
+        # Later refreshes only hand the changed files to the workers
+        directory = os.path.join(TEST_DIR_PATH, "dir0")
+        for executor in ("thread", "process"):
+            loaded = Preferences(directory, workers=2, executor=executor)
+            self.assertEqual(loaded.refresh(), set())
+            for j in range(2):
+                with open(os.path.join(directory, "{}.settings.json".format(j)), "w") as file:
+                    json.dump([{"key": "key_{}".format(j), "value": executor}], file)
+            self.assertEqual(loaded.refresh(), {"key_0", "key_1"})
+            self.assertEqual(loaded.key_1, executor)
+            self.assertEqual(loaded.refresh(), set())
+
+    def test_unchanged_survives_pickling(self):
+        self.assertIs(pickle.loads(pickle.dumps(prefy.UNCHANGED)), prefy.UNCHANGED)
+
+    def test_compiled_settings(self):
+        settings_dir = os.path.join(TEST_DIR_PATH, "settings")
+        os.makedirs(settings_dir)
+        compiled_path = os.path.join(TEST_DIR_PATH, "settings.compiled")
+        with open(os.path.join(settings_dir, "1.base.json"), "w") as file:
+            json.dump([{"key": "color", "value": "blue"}, {"key": "live", "value": 1, "force_update": True}], file)
+        with open(os.path.join(settings_dir, "2.override.json"), "w") as file:
+            json.dump([{"key": "color", "value": "red"}], file)
+        with open(os.path.join(settings_dir, "3_prompt.txt"), "w") as file:
+            file.write("Prompt")
+
+        expected = dict(Preferences(settings_dir, compiled_path=compiled_path))
+        self.assertTrue(os.path.isfile(compiled_path))
+
+        # Nothing changed: no file is parsed
+        with mock.patch.object(prefy, "parse_settings_file", wraps=prefy.parse_settings_file) as parse:
+            result = Preferences(settings_dir, compiled_path=compiled_path)
+            self.assertEqual(parse.call_count, 0)
+        self.assertEqual(dict(result), expected)
+        self.assertEqual(result.meta.updateable_fields, {"live"})
+        self.assertEqual(result.meta.files_loaded, 3)
+
+        # A file changed: only that file is parsed and the compiled settings are rebuilt
+        with open(os.path.join(settings_dir, "2.override.json"), "w") as file:
+            json.dump([{"key": "color", "value": "green"}], file)
+        with mock.patch.object(prefy, "parse_settings_file", wraps=prefy.parse_settings_file) as parse:
+            self.assertEqual(Preferences(settings_dir, compiled_path=compiled_path).color, "green")
+            self.assertEqual(parse.call_count, 1)
+        with mock.patch.object(prefy, "parse_settings_file", wraps=prefy.parse_settings_file) as parse:
+            self.assertEqual(Preferences(settings_dir, compiled_path=compiled_path).color, "green")
+            self.assertEqual(parse.call_count, 0)
+
+    def test_metrics_and_hooks(self):
+        json_file = os.path.join(TEST_DIR_PATH, "1.settings.json")
+        with open(json_file, "w") as file:
+            json.dump([{"key": "live", "value": 1, "force_update": True}], file)
+        with open(os.path.join(TEST_DIR_PATH, "2.deactivated.json"), "w") as file:
+            json.dump([{"type": "Prefy", "key": "deactivate_setting_file", "value": True}], file)
+        with open(os.path.join(TEST_DIR_PATH, "3.invalid.json"), "w") as file:
+            file.write("Hello, World!")
+
+        events = []
+        class RecordingHooks(PreferencesHooks):
+            def on_file_read(self, preferences, file_name, bytes_read, read_time, parse_time):
+                events.append(file_name)
+
+        result = Preferences(TEST_DIR_PATH, hooks=[RecordingHooks()])
+        metrics = result.meta.metrics
+        self.assertEqual(sorted(events), ["1.settings.json", "2.deactivated.json", "3.invalid.json"])
+        self.assertEqual(metrics.refresh_count, 1)
+        self.assertEqual(metrics.bytes_read, sum(os.path.getsize(os.path.join(TEST_DIR_PATH, f)) for f in os.listdir(TEST_DIR_PATH)))
+        self.assertEqual(metrics.files_skipped, {"deactivated": 1, "invalid": 1})
+
+        result.live
+        result.live
+        self.assertEqual(metrics.force_update_refreshes["live"], 2)
+        self.assertEqual(metrics.refresh_count, 3)
+        # Unchanged files are not read again, and files_loaded does not accumulate across refreshes
+        self.assertEqual(metrics.files_read, 3)
+        self.assertEqual(result.meta.files_loaded, 1)
+
+    def test_snapshot_generations(self):
+        json_file = os.path.join(TEST_DIR_PATH, "1.settings.json")
+        def write(value, live): # Atomically, since readers of "a" may refresh while the file is written
+            with open(json_file + ".tmp", "w") as file:
+                json.dump([{"key": "a", "value": value, "force_update": live}, {"key": "b", "value": value}], file)
+            os.replace(json_file + ".tmp", json_file)
+
+        write(0, False)
+        result = Preferences(TEST_DIR_PATH)
+        generation = result.meta.generation
+        result.refresh()
+        self.assertEqual(result.meta.generation, generation, "A refresh without changes must not publish a new generation")
+
+        errors = []
+        done = threading.Event()
+        def read():
+            while not done.is_set():
+                try:
+                    snapshot = result.meta.snapshot
+                    if snapshot.values["a"] != snapshot.values["b"]:
+                        errors.append("Inconsistent snapshot")
+                    result.a
+                    result.b
+                except AttributeError as e:
+                    errors.append(e)
+        readers = [threading.Thread(target=read) for _ in range(2)]
+        for reader in readers:
+            reader.start()
+        try:
+            for i in range(1, 20):
+                write(i, i % 2 == 0) # Also moves "a" in and out of the updateable fields
+                result.refresh()
+        finally:
+            done.set()
+            for reader in readers:
+                reader.join()
+        self.assertEqual(errors, [])
+        self.assertGreater(result.meta.generation, generation)
+        with self.assertRaises(TypeError):
+            result.meta.snapshot.values["a"] = 0
+
+    def test_refresh_overrides_ad_hoc_values(self):
+        json_file = os.path.join(TEST_DIR_PATH, "1.settings.json")
+        with open(json_file, "w") as file:
+            json.dump([{"key": "color", "value": "file"}, {"key": "live", "value": "file", "force_update": True}], file)
+        result = Preferences(TEST_DIR_PATH, ad_hoc_prefs={"color": "adhoc", "live": "adhoc"})
+        self.assertEqual(result.color, "adhoc")
+        result.extra = "kept"
+
+        # File values win on every refresh, even when no file changed
+        self.assertEqual(result.refresh(), set())
+        self.assertEqual((result.color, result.live, result.extra), ("file", "file", "kept"))
+
+        # Attributes that no file defines survive refreshes that change settings
+        with open(json_file, "w") as file:
+            json.dump([{"key": "color", "value": "new"}], file)
+        result.refresh()
+        self.assertEqual((result.color, result.extra), ("new", "kept"))
+
+    def test_async_preferences(self):
+        json_file = os.path.join(TEST_DIR_PATH, "1.settings.json")
+        with open(json_file, "w") as file:
+            json.dump([{"key": "plain", "value": 1}, {"key": "live", "value": "old", "force_update": True}], file)
+
+        async def scenario():
+            result = await AsyncPreferences.create(TEST_DIR_PATH)
+            self.assertEqual(result.plain, 1)
+            changes = result.changes()
+            next_change = asyncio.ensure_future(changes.__anext__())
+
+            with open(json_file, "w") as file:
+                json.dump([{"key": "plain", "value": 1}, {"key": "live", "value": "new", "force_update": True}], file)
+            # Attribute reads never touch the filesystem
+            self.assertEqual(result.live, "old")
+
+            refresh_count = result.meta.metrics.refresh_count
+            outcomes = await asyncio.gather(*[result.refresh() for _ in range(10)])
+            self.assertEqual(result.meta.metrics.refresh_count, refresh_count + 1)
+            self.assertEqual(outcomes, [{"live"}] * 10)
+            self.assertEqual(await asyncio.wait_for(next_change, 5), {"live"})
+            self.assertEqual(result.live, "new")
+
+            with open(json_file, "w") as file:
+                json.dump([{"key": "plain", "value": 1}, {"key": "live", "value": "newer", "force_update": True}], file)
+            self.assertEqual(await result.get("live"), "newer")
+            await changes.aclose()
+
+            # Lazy .txt files are only read by get(), in the executor
+            with open(os.path.join(TEST_DIR_PATH, "2_prompt.txt"), "w") as file:
+                file.write("Prompt")
+            lazy = await AsyncPreferences.create(TEST_DIR_PATH, lazy_text=True)
+            with self.assertRaises(AttributeError):
+                lazy.prompt
+            self.assertEqual(await lazy.get("prompt"), "Prompt")
+            self.assertEqual(lazy.prompt, "Prompt")
+
+            # Items kept up to date by a collection's watcher are not refreshed by get()
+            lazy.preferences.meta.refresh_on_read = False
+            refresh_count = lazy.meta.metrics.refresh_count
+            self.assertEqual(await lazy.get("live"), "newer")
+            self.assertEqual(lazy.meta.metrics.refresh_count, refresh_count)
+
+            # Settings named like methods shadow neither the wrapped nor the async methods
+            with open(json_file, "w") as file:
+                json.dump([{"key": "refresh", "value": "plain"}, {"key": "get", "value": "live", "force_update": True}], file)
+            self.assertIn("refresh", await result.refresh())
+            self.assertEqual(await result.get("refresh"), "plain")
+            self.assertEqual(await result.get("get"), "live")
+
+        asyncio.run(scenario())
+
+    def test_async_preferences_collection(self):
+        for name in ("dir1", "dir2"):
+            os.makedirs(os.path.join(TEST_DIR_PATH, name))
+            with open(os.path.join(TEST_DIR_PATH, name, "settings.json"), "w") as file:
+                json.dump([{"key": "file_name", "value": name}], file)
+
+        async def scenario():
+            collection = await AsyncPreferencesCollection.create(TEST_DIR_PATH, lazy=True)
+            self.assertEqual(collection.collection.loaded_items(), [])
+            self.assertEqual((await collection.get_by_name("dir2")).file_name, "dir2")
+            with self.assertRaises(KeyError):
+                await collection.get_by_name("unknown")
+
+        asyncio.run(scenario())
+
+    def test_shared_parse_cache(self):
+        prefy.PARSE_CACHE.clear()
+        records = [{"key": "model_name", "value": "shared-model"}, {"key": "options", "value": {"temperature": 0.3}}]
+        for name in ("tenant1", "tenant2"):
+            os.makedirs(os.path.join(TEST_DIR_PATH, name))
+            with open(os.path.join(TEST_DIR_PATH, name, "0.base.json"), "w") as file:
+                json.dump(records, file)
+            with open(os.path.join(TEST_DIR_PATH, name, "1.own.json"), "w") as file:
+                json.dump([{"key": "tenant", "value": name}, {"key": "greeting", "value": "hello " + "world"}], file)
+        os.makedirs(os.path.join(TEST_DIR_PATH, "tenant3"))
+        os.symlink(os.path.abspath(os.path.join(TEST_DIR_PATH, "tenant1", "0.base.json")), os.path.join(TEST_DIR_PATH, "tenant3", "0.base.json"))
+
+        collection = PreferencesCollection(TEST_DIR_PATH, share_parsed_files=True)
+        tenant1, tenant2, tenant3 = (collection.get_by_name(name) for name in ("tenant1", "tenant2", "tenant3"))
+        # Copies and symlinks of a file share the same parsed values
+        self.assertIs(tenant1.options, tenant2.options)
+        self.assertIs(tenant1.options, tenant3.options)
+        self.assertEqual(tenant2.tenant, "tenant2")
+        # Identical strings of different files are interned
+        self.assertIs(tenant1.greeting, tenant2.greeting)
+        # Files served from the cache by identity are not reported as read
+        self.assertEqual(tenant3.meta.metrics.files_read, 0)
+        self.assertEqual(tenant2.meta.metrics.files_read, 2)
+
+        # Worker processes cannot share their parsed files with this process
+        with self.assertRaises(ValueError):
+            PreferencesCollection(TEST_DIR_PATH, share_parsed_files=True, workers=2, executor="process")
+        with self.assertRaises(ValueError):
+            Preferences(os.path.join(TEST_DIR_PATH, "tenant1"), share_parsed_files=True, workers=2, executor="process")
+
+        # Without the shared cache, each instance has its own copy
+        own = Preferences(os.path.join(TEST_DIR_PATH, "tenant1"))
+        self.assertIsNot(own.options, tenant1.options)
+        self.assertEqual(own.options, tenant1.options)
+
+    def test_lazy_text(self):
+        txt_file = os.path.join(TEST_DIR_PATH, "1_system prompt.txt")
+        with open(txt_file, "w") as file:
+            file.write("  First version\n")
+        with open(os.path.join(TEST_DIR_PATH, "2.settings.json"), "w") as file:
+            json.dump([{"key": "plain", "value": 1}], file)
+
+        result = Preferences(TEST_DIR_PATH, lazy_text=True)
+        lazy = result.meta.snapshot.values["system_prompt"]
+        self.assertFalse(lazy.loaded)
+        self.assertEqual(result.meta.metrics.files_read, 1)
+        self.assertEqual(result.system_prompt, "First version")
+        self.assertTrue(lazy.loaded)
+
+        # The content is kept as long as the file does not change
+        result.refresh()
+        self.assertIs(result.meta.snapshot.values["system_prompt"], lazy)
+        with open(txt_file, "w") as file:
+            file.write("Second version, longer")
+        self.assertEqual(result.refresh(), {"system_prompt"})
+        self.assertEqual(result.system_prompt, "Second version, longer")
+        self.assertEqual(dict(result)["system_prompt"], "Second version, longer")
+
+        os.remove(txt_file)
+        result.refresh()
+        with self.assertRaises(AttributeError):
+            result.system_prompt
+
+        # A file removed before its first access is a missing attribute
+        with open(txt_file, "w") as file:
+            file.write("Third version")
+        result = Preferences(TEST_DIR_PATH, lazy_text=True)
+        tolerant = Preferences(TEST_DIR_PATH, lazy_text=True, allow_missing_attributes=True)
+        os.remove(txt_file)
+        self.assertFalse(hasattr(result, "system_prompt"))
+        self.assertIsNone(tolerant.system_prompt)
+        self.assertEqual(dict(result)["plain"], 1)
+
+    def test_streaming_parser(self):
+        self.assertEqual(list(streaming.iter_array(' [ {"a": 1} , {"b": [2]} ] ')), [{"a": 1}, {"b": [2]}])
+        self.assertEqual(list(streaming.iter_array('[]')), [])
+        for invalid in ('', '{"a": 1}', '[{"a": 1}', '[{"a": 1}] trailing', '[{"a": 1} {"b": 2}]', 'Hello, World!'):
+            with self.assertRaises(json.JSONDecodeError, msg=invalid):
+                list(streaming.iter_array(invalid))
+
+        # Only files whose deactivation record looks true are parsed one record at a time
+        self.assertTrue(prefy.likely_deactivated('[{"value": 1, "key": "deactivate_setting_file"}]'))
+        self.assertTrue(prefy.likely_deactivated('[{"key": "deactivate_setting_file", "description": "false", "value":true}]'))
+        self.assertFalse(prefy.likely_deactivated('[{"key": "deactivate_setting_file", "value": false}, {"key": "a", "value": true}]'))
+        self.assertFalse(prefy.likely_deactivated('[{"key": "deactivate_setting_file", "value": 10}]'))
+
+        # Parsing stops at the deactivation record: what comes after it is never parsed
+        with open(os.path.join(TEST_DIR_PATH, "1.deactivated.json"), "w") as file:
+            file.write('[{"type": "Prefy", "key": "deactivate_setting_file", "value": true}, not even json')
+        with open(os.path.join(TEST_DIR_PATH, "2.settings.json"), "w") as file:
+            json.dump([{"type": "Prefy", "key": "deactivate_setting_file", "value": False}, {"key": "plain", "value": 1}], file)
+        with open(os.path.join(TEST_DIR_PATH, "3.invalid.json"), "w") as file:
+            file.write('{"key": "not a list"}')
+
+        results = []
+        for backend in (streaming.orjson, None):
+            with mock.patch.object(streaming, "orjson", backend):
+                result = Preferences(TEST_DIR_PATH)
+            statuses = {name: entry.status for name, entry in result.meta.file_entries.items()}
+            self.assertEqual(statuses, {"1.deactivated.json": "deactivated", "2.settings.json": "loaded", "3.invalid.json": "invalid"})
+            results.append(dict(result))
+        self.assertEqual(results[0], results[1])
+        self.assertEqual(results[0]["plain"], 1)
+
+    def test_shared_store(self):
+        settings_dir = os.path.join(TEST_DIR_PATH, "settings")
+        os.makedirs(settings_dir)
+        store_path = os.path.join(TEST_DIR_PATH, "store")
+        json_file = os.path.join(settings_dir, "1.settings.json")
+        with open(json_file, "w") as file:
+            json.dump([{"key": "plain", "value": 1}, {"key": "live", "value": "old", "force_update": True}], file)
+
+        writer = Preferences(settings_dir, shared_store=store_path)
+        reader = Preferences(settings_dir, shared_store=store_path)
+        try:
+            self.assertTrue(writer.meta.shared_store.is_writer)
+            self.assertIsNotNone(writer.meta.watcher)
+            self.assertFalse(reader.meta.shared_store.is_writer)
+            self.assertEqual(reader.meta.files, [], "Readers do not list the directory")
+            self.assertEqual((reader.plain, reader.live), (1, "old"))
+
+            generation = writer.meta.shared_store.generation
+            with open(json_file, "w") as file:
+                json.dump([{"key": "plain", "value": 1}, {"key": "live", "value": "new", "force_update": True}], file)
+            self.assertTrue(wait_for(lambda: writer.meta.shared_store.generation > generation))
+            self.assertEqual(reader.live, "new")
+
+            # When the writer goes away, a reader takes over
+            writer.stop_watching()
+            writer.meta.shared_store.close()
+            with mock.patch.object(shared, "TAKEOVER_INTERVAL", 0):
+                reader.refresh()
+            self.assertTrue(reader.meta.shared_store.is_writer)
+            self.assertTrue(wait_for(lambda: reader.meta.watcher is not None))
+
+            # Store files are private, and stores built from another directory are ignored
+            store = reader.meta.shared_store
+            data_path = store.data_path(store.generation)
+            self.assertEqual(os.stat(data_path).st_mode & 0o777, 0o600)
+            other_dir = os.path.join(TEST_DIR_PATH, "other")
+            os.makedirs(other_dir)
+            with open(os.path.join(other_dir, "1.settings.json"), "w") as file:
+                json.dump([{"key": "plain", "value": 2}], file)
+            with self.assertLogs(level="WARNING"):
+                other = Preferences(other_dir, shared_store=store_path)
+            try:
+                self.assertEqual(other.plain, 2)
+            finally:
+                other.meta.shared_store.close()
+
+            # Data files that other users could have written are refused
+            os.chmod(data_path, 0o666)
+            untrusted = shared.SharedStore(store_path, settings_dir)
+            try:
+                with self.assertRaises(PermissionError):
+                    untrusted.read(force=True)
+            finally:
+                untrusted.close()
+        finally:
+            reader.stop_watching()
+            reader.meta.shared_store.close()
+
+    def test_preferences_wrapper_registry(self):
+        json_file = os.path.join(TEST_DIR_PATH, "1.settings.json")
+        with open(json_file, "w") as file:
+            json.dump([{"key": "color", "value": "blue"}], file)
+
+        wrappers = [PreferencesWrapper(directory_path=TEST_DIR_PATH) for _ in range(3)]
+        wrappers.append(PreferencesWrapper(directory_path=TEST_DIR_PATH + os.sep))
+        shared_settings = wrappers[0].settings
+        self.assertTrue(all(wrapper.settings is shared_settings for wrapper in wrappers))
+        self.assertEqual(PREFERENCES_REGISTRY.references(shared_settings), 4)
+
+        # Refreshing through one wrapper refreshes the instance all of them use
+        with open(json_file, "w") as file:
+            json.dump([{"key": "color", "value": "red"}], file)
+        refresh_count = shared_settings.meta.metrics.refresh_count
+        self.assertEqual(wrappers[1].refresh_settings(), {"color"})
+        self.assertEqual(shared_settings.meta.metrics.refresh_count, refresh_count + 1)
+        self.assertEqual(wrappers[2].settings.color, "red")
+
+        # Wrappers given their own settings do not use the registry
+        own = PreferencesWrapper(settings=Preferences(TEST_DIR_PATH))
+        self.assertIsNot(own.settings, shared_settings)
+
+        # Wrappers release their reference when they are garbage collected
+        wrappers.pop()
+        self.assertEqual(PREFERENCES_REGISTRY.references(shared_settings), 3)
+
+        # Wrappers created one after another reuse the instance even once nobody holds it anymore
+        PREFERENCES_REGISTRY.invalidate()
+        sequential = [id(PreferencesWrapper(directory_path=TEST_DIR_PATH).settings) for _ in range(3)]
+        self.assertEqual(len(set(sequential)), 1)
+        self.assertEqual(PREFERENCES_REGISTRY.references(PreferencesWrapper(directory_path=TEST_DIR_PATH).settings), 0)
+        shared_settings = PreferencesWrapper(directory_path=TEST_DIR_PATH).settings
+        self.assertEqual(id(shared_settings), sequential[0])
+
+        PREFERENCES_REGISTRY.invalidate(TEST_DIR_PATH)
+        self.assertIsNot(PreferencesWrapper(directory_path=TEST_DIR_PATH).settings, shared_settings)
+        PREFERENCES_REGISTRY.invalidate()
+
+        # Unless the registry is told to forget unused instances
+        registry = prefy.PreferencesRegistry(keep_unused=False)
+        first = registry.acquire(TEST_DIR_PATH)
+        registry.release(first)
+        self.assertEqual(registry.entries, {})
+        self.assertIsNot(registry.acquire(TEST_DIR_PATH), first)
+
+        # Concurrent acquires of a directory wait for a single load
+        loads = []
+        def slow_preferences(**options):
+            loads.append(options)
+            time.sleep(0.1)
+            return Preferences(**options)
+        registry = prefy.PreferencesRegistry()
+        with mock.patch.object(prefy, "Preferences", side_effect=slow_preferences):
+            results = []
+            threads = [threading.Thread(target=lambda: results.append(registry.acquire(TEST_DIR_PATH))) for _ in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(len(loads), 1)
+        self.assertEqual(len(results), 4)
+        self.assertTrue(all(result is results[0] for result in results))
+        self.assertEqual(registry.references(results[0]), 4)
+
+        # Failed loads are not kept, so that the next acquire tries again
+        with self.assertRaises(OSError):
+            registry.acquire(os.path.join(TEST_DIR_PATH, "missing"))
+        self.assertEqual(registry.entries.keys(), {registry.key(TEST_DIR_PATH, {})})
+
+    def test_targeted_refresh_and_bulk_reads(self):
+        live_file = os.path.join(TEST_DIR_PATH, "1.live.json")
+        static_file = os.path.join(TEST_DIR_PATH, "2.static.json")
+        with open(live_file, "w") as file:
+            json.dump([{"key": "color", "value": "blue"}, {"key": "live", "value": "old", "force_update": True}], file)
+        with open(static_file, "w") as file:
+            json.dump([{"key": "color", "value": "red"}, {"key": "size", "value": 1}], file)
+        result = Preferences(TEST_DIR_PATH, ad_hoc_prefs={"extra": 42})
+        self.assertEqual(result.meta.key_sources["color"], (("1.live.json", 0), ("2.static.json", 0)))
+        self.assertEqual(result.meta.key_sources["live"], (("1.live.json", 1),))
+
+        # Reading a force_update key only re-reads the file defining it
+        static_entry = result.meta.file_entries["2.static.json"]
+        with open(static_file, "w") as file:
+            json.dump([{"key": "color", "value": "green"}, {"key": "size", "value": 2}], file)
+        with open(live_file, "w") as file:
+            json.dump([{"key": "color", "value": "blue"}, {"key": "live", "value": "new", "force_update": True}], file)
+        files_read = result.meta.metrics.files_read
+        self.assertEqual(result.live, "new")
+        self.assertEqual(result.meta.metrics.files_read, files_read + 1)
+        self.assertIs(result.meta.file_entries["2.static.json"], static_entry)
+        self.assertEqual(result.size, 1)
+
+        # A full refresh picks up the other files
+        result.refresh()
+        self.assertEqual(result.size, 2)
+
+        # Bulk reads check the freshness of all the keys at once
+        with open(live_file, "w") as file:
+            json.dump([{"key": "color", "value": "blue"}, {"key": "live", "value": "newer", "force_update": True}], file)
+        refresh_count = result.meta.metrics.refresh_count
+        self.assertEqual(result.get_many(["live", "size", "extra"]), {"live": "newer", "size": 2, "extra": 42})
+        self.assertEqual(result.meta.metrics.refresh_count, refresh_count + 1)
+        with self.assertRaises(AttributeError):
+            result.get_many(["unknown"])
+
+        snapshot = result.snapshot()
+        self.assertEqual(snapshot["color"], "green")
+        self.assertEqual(snapshot["live"], "newer")
+        with self.assertRaises(TypeError):
+            snapshot["color"] = "black"
+
+        # Bulk reads return what attribute reads return, including ad hoc values
+        result.color = "adhoc"
+        self.assertEqual(result.get_many(["color"]), {"color": result.color})
+        snapshot = result.snapshot() #Refreshes the live key, and file values take precedence again
+        self.assertEqual(snapshot["color"], result.color)
+        self.assertEqual(dict(snapshot), dict(result))
+
+        # Deleting the source file of a key retracts it
+        os.remove(live_file)
+        with self.assertRaises(AttributeError):
+            result.live
+        self.assertEqual(result.meta.files, ["2.static.json"])
+
+        # A file added since the last full refresh is picked up, and may override a force_update key
+        with open(static_file, "w") as file:
+            json.dump([{"key": "live", "value": "static", "force_update": True}], file)
+        result.refresh()
+        self.assertEqual(result.live, "static")
+        with open(os.path.join(TEST_DIR_PATH, "ZZZ_debug.json"), "w") as file:
+            json.dump([{"key": "live", "value": "debug"}], file)
+        self.assertEqual(result.live, "debug")
+        self.assertEqual(result.meta.files, ["2.static.json", "ZZZ_debug.json"])
+
+    def test_keys_named_like_methods(self):
+        json_file = os.path.join(TEST_DIR_PATH, "1.settings.json")
+        records = [{"key": "notify", "value": True}, {"key": "subscribe", "value": "yes"},
+                   {"key": "watch", "value": 1}, {"key": "stop_watching", "value": 2},
+                   {"key": "publish", "value": 3}, {"key": "load_merged", "value": 4}, {"key": "scan_files", "value": 5}]
+        with open(json_file, "w") as file:
+            json.dump(records, file)
+        changes = []
+        with self.assertLogs(level="WARNING"):
+            result = Preferences(TEST_DIR_PATH, on_change=changes.append)
+        self.assertIs(result.notify, True)
+
+        with open(json_file, "w") as file:
+            json.dump(records + [{"key": "color", "value": "red"}], file)
+        self.assertEqual(result.refresh(), {"color"})
+        self.assertEqual(changes[-1], {"color"})
+        self.assertEqual(result.refresh(), set())
+        self.assertEqual(result.publish, 3)
+
+        with open(json_file, "w") as file:
+            json.dump([{"key": "emit", "value": True}, {"key": "report_scanned_files", "value": True},
+                       {"key": "set_ad_hoc_prefs", "value": True}], file)
+        with self.assertLogs(level="WARNING"):
+            self.assertEqual(Preferences(TEST_DIR_PATH, ad_hoc_prefs={"extra": 1}).meta.metrics.files_read, 1)
+
+        watched = Preferences(TEST_DIR_PATH, watch=True)
+        self.assertIsNotNone(watched.meta.watcher)
+        Preferences.stop_watching(watched)
+
     def tearDown(self):
         shutil.rmtree(TEST_DIR_PATH)
\ No newline at end of file